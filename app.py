@@ -1,28 +1,219 @@
 
 
+import time
+# زمان شروع بارگذاری ماژول برای اندازه‌گیری زمان راه‌اندازی
+_IMPORT_STARTED = time.perf_counter()
 import os
 import re
-from datetime import datetime
+import csv
+import io
+import hashlib
+import statistics
+import threading
+import atexit
+import heapq
+import itertools
+import math
+import sqlite3
+import tempfile
+import gzip
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from datetime import date, datetime
+from datetime import time as dt_time
+from decimal import Decimal
 import pytz
 import jdatetime
-from flask import Flask, render_template, request, redirect, url_for, flash, session
-from sqlalchemy import create_engine, text
+try:
+    import fcntl
+except ImportError:  # ویندوز؛ فقط محدودیت داخل هر worker اعمال می‌شود
+    fcntl = None
+try:
+    import numpy as np
+except ImportError:  # مقایسه نتایج با پایتون خالص انجام می‌شود
+    np = None
+from flask import Flask, render_template, request, redirect, url_for, flash, session, Response, g, has_request_context, jsonify, make_response
+from sqlalchemy import bindparam, create_engine, event, inspect, text
+from sqlalchemy import types as sqltypes
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+from werkzeug.middleware.proxy_fix import ProxyFix
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess,
+)
 import json
 # ==================== تنظیمات ====================
+
+def make_engine(uri: str, prefix: str, pool_size: int = 5, max_overflow: int = 10,
+                pool_recycle: int = 1800, pool_timeout: float = 30):
+    """ساخت engine با تنظیمات pool از متغیرهای محیطی با پیشوند prefix (مثلاً DB_POOL_SIZE)"""
+    options = {"pool_pre_ping": True}
+    # pool پیش‌فرض SQLite این تنظیمات را نمی‌پذیرد
+    if make_url(uri).get_backend_name() != "sqlite":
+        options.update(
+            pool_size=int(os.environ.get(f"{prefix}_POOL_SIZE", pool_size)),
+            max_overflow=int(os.environ.get(f"{prefix}_MAX_OVERFLOW", max_overflow)),
+            pool_recycle=int(os.environ.get(f"{prefix}_POOL_RECYCLE", pool_recycle)),
+            pool_timeout=float(os.environ.get(f"{prefix}_POOL_TIMEOUT", pool_timeout)),
+        )
+    return create_engine(uri, **options)
+
+class LazyEngine:
+    """engine را در اولین استفاده می‌سازد.
+
+    با gunicorn --preload ماژول در پردازه اصلی import می‌شود؛ چون هنوز اتصالی باز
+    نشده، workerها اتصال مشترک به ارث نمی‌برند. dispose() در post_fork هم هر اتصالی
+    را که پردازه اصلی باز کرده باشد از pool فرزند جدا می‌کند.
+    """
+
+    def __init__(self, name: str, uri: str, prefix: str, **pool_defaults):
+        self.name = name
+        self.uri = uri
+        self.prefix = prefix
+        self.pool_defaults = pool_defaults
+        # سازنده engine؛ قابل جایگزینی (مثلاً با snapshot تصحیح) قبل از اولین استفاده
+        self.factory = make_engine
+        self._engine = None
+        self._lock = threading.Lock()
+
+    @property
+    def created(self) -> bool:
+        return self._engine is not None
+
+    def get(self):
+        if self._engine is None:
+            with self._lock:
+                if self._engine is None:
+                    bind = self.factory(self.uri, self.prefix, **self.pool_defaults)
+                    instrument_engine(bind, self.name)
+                    self._engine = bind
+        return self._engine
+
+    def reset(self):
+        """کنار گذاشتن engine فعلی؛ get() بعدی آن را دوباره می‌سازد. اتصال‌هایی که الان
+        دست درخواست‌ها هستند تا پایان کارشان معتبر می‌مانند و بعد بسته می‌شوند."""
+        with self._lock:
+            old, self._engine = self._engine, None
+        if old is not None:
+            old.dispose()
+
+    def dispose(self, close: bool = True):
+        if self._engine is not None:
+            # close=False: اتصال‌های پردازه والد بسته نمی‌شوند، فقط در فرزند کنار گذاشته می‌شوند
+            self._engine.dispose(close=close)
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
+
 DB_URI = os.environ.get("DB_URI", "sqlite:///./local_test.db")
-engine = create_engine(DB_URI, pool_pre_ping=True)
+# کوئری‌های دانشجو روی engine جداگانه اجرا می‌شوند تا pool ورود و صفحات ادمین را پر نکنند.
+# بهتر است GRADING_DB_URI به یک نقش فقط‌خواندنی یا replica اشاره کند.
+GRADING_DB_URI = os.environ.get("GRADING_DB_URI", DB_URI)
+GRADING_STATEMENT_TIMEOUT_MS = int(os.environ.get("GRADING_STATEMENT_TIMEOUT_MS", "10000"))
+# تلرانس مطلق مقایسه ستون‌های اعشاری (Decimal در برابر float، گرد شدن AVG و ...)؛
+# ستون‌هایی که فقط عدد صحیح دارند همیشه دقیق مقایسه می‌شوند
+COMPARE_FLOAT_TOLERANCE = float(os.environ.get("COMPARE_FLOAT_TOLERANCE", "1e-6"))
+# برای نتایج کوچک هزینه ساخت آرایه‌های numpy از خود مقایسه بیشتر است
+VECTORIZED_COMPARE_MIN_ROWS = int(os.environ.get("VECTORIZED_COMPARE_MIN_ROWS", "500"))
+# بررسی plan کوئری دانشجو پیش از اجرا. QUERY_COST_LIMIT سقف Total Cost در Postgres است،
+# QUERY_CROSS_JOIN_ROWS سقف ردیف‌های تخمینی nested loop بدون شرط اتصال، و
+# QUERY_MAX_FULL_SCANS سقف تعداد SCAN کامل جدول داخل حلقه‌های تو در توی plan در SQLite (0 یعنی غیرفعال).
+QUERY_PLAN_GUARD = os.environ.get("QUERY_PLAN_GUARD", "1") == "1"
+QUERY_COST_LIMIT = float(os.environ.get("QUERY_COST_LIMIT", "1000000"))
+QUERY_CROSS_JOIN_ROWS = float(os.environ.get("QUERY_CROSS_JOIN_ROWS", "100000"))
+QUERY_MAX_FULL_SCANS = int(os.environ.get("QUERY_MAX_FULL_SCANS", "3"))
+QUERY_PLAN_CACHE_SIZE = int(os.environ.get("QUERY_PLAN_CACHE_SIZE", "2000"))
+# امتیاز کارایی: زمان اجرا و هزینه plan پاسخ‌های درست در مقایسه با حل رسمی.
+# زمان‌سنجی فقط در نیمه اول مهلت GRADING_STATEMENT_TIMEOUT_MS همان ارسال انجام می‌شود.
+EFFICIENCY_SCORING = os.environ.get("EFFICIENCY_SCORING", "0") == "1"
+EFFICIENCY_RUNS = int(os.environ.get("EFFICIENCY_RUNS", "3"))
+EFFICIENCY_WARMUP_RUNS = int(os.environ.get("EFFICIENCY_WARMUP_RUNS", "1"))
+# GRADING_BACKEND=snapshot: کوئری‌های دانشجو روی یک کپی SQLite از داده‌های درس در خود worker
+# اجرا می‌شوند. با GRADING_SNAPSHOT_PATH فایل ساخته‌شده با `flask build-grading-snapshot`
+# فقط‌خواندنی و با mmap باز می‌شود؛ بدون آن هر worker کپی را در حافظه می‌سازد.
+GRADING_BACKEND = os.environ.get("GRADING_BACKEND", "database")
+GRADING_SNAPSHOT_PATH = os.environ.get("GRADING_SNAPSHOT_PATH")
+GRADING_SNAPSHOT_MMAP_BYTES = int(os.environ.get("GRADING_SNAPSHOT_MMAP_BYTES", str(256 * 1024 * 1024)))
+# هر چند ثانیه یک بار بررسی می‌شود که جدول‌های مرجع پس از ساخت snapshot عوض شده‌اند یا نه
+GRADING_SNAPSHOT_REFRESH_SECONDS = int(os.environ.get("GRADING_SNAPSHOT_REFRESH_SECONDS", "30"))
+
+engine = LazyEngine("app", DB_URI, "DB")
+grading_engine = LazyEngine("grading", GRADING_DB_URI, "GRADING_DB", max_overflow=5, pool_timeout=5)
+
+def dispose_engines(close: bool = True):
+    """رها کردن اتصال‌های همه engineها (در post_fork با close=False)"""
+    engine.dispose(close=close)
+    grading_engine.dispose(close=close)
 # اضافه کردن در ابتدای فایل
 ADMIN_USERNAME = os.environ.get("ADMIN_USERNAME")
 ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD")
 
-try:
-    with engine.begin() as conn:
-        conn.execute(text("SELECT 1"))
-except:
-    pass
+# محدودیت‌های کنسول SQL ادمین
+ADMIN_QUERY_ROW_LIMIT = int(os.environ.get("ADMIN_QUERY_ROW_LIMIT", "200"))
+ADMIN_QUERY_TIMEOUT_MS = int(os.environ.get("ADMIN_QUERY_TIMEOUT_MS", "30000"))
+
+# نوشتن دسته‌ای لاگ‌ها در پس‌زمینه
+LOG_FLUSH_BATCH_SIZE = int(os.environ.get("LOG_FLUSH_BATCH_SIZE", "100"))
+LOG_FLUSH_INTERVAL_SECONDS = float(os.environ.get("LOG_FLUSH_INTERVAL_SECONDS", "5"))
+
+# اگر تنظیم شود، /metrics فقط با هدر Authorization: Bearer <token> پاسخ می‌دهد
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+# لاگ کوئری‌های کند و بودجه تعداد کوئری در هر درخواست
+APP_ENV = os.environ.get("APP_ENV", "production")
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "200"))
+QUERY_BUDGET = int(os.environ.get("QUERY_BUDGET", "30"))
+
+# کنترل پذیرش برای تصحیح و اجرای کوئری آزمایشی
+GRADING_WORKER_SLOTS = int(os.environ.get("GRADING_WORKER_SLOTS", "4"))
+GRADING_GLOBAL_SLOTS = int(os.environ.get("GRADING_GLOBAL_SLOTS", "8"))
+GRADING_MAX_QUEUE = int(os.environ.get("GRADING_MAX_QUEUE", "20"))
+GRADING_MAX_WAIT_SECONDS = float(os.environ.get("GRADING_MAX_WAIT_SECONDS", "5"))
+# سقف کارهای همزمان (در صف یا در حال اجرا) هر دانشجو؛ 0 یعنی بدون سقف
+GRADING_MAX_PER_STUDENT = int(os.environ.get("GRADING_MAX_PER_STUDENT", "1"))
+ADMISSION_LOCK_DIR = os.environ.get(
+    "ADMISSION_LOCK_DIR", os.path.join(tempfile.gettempdir(), "dbhw-admission")
+)
+
+# ورود گروهی دانشجویان از CSV
+ROSTER_BATCH_SIZE = int(os.environ.get("ROSTER_BATCH_SIZE", "500"))
+
+# اگر تنظیم شود، جدول‌های مرجع ساخته‌شده به این نقش (نقش فقط‌خواندنی تصحیح) GRANT می‌شوند
+GRADING_DB_ROLE = os.environ.get("GRADING_DB_ROLE")
+
+# سقف تعداد ارسال هر تمرین برای هر دانشجو
+MAX_SUBMISSIONS = 10
+# کش خلاصه تاریخچه ارسال‌های هر دانشجو در هر worker
+HISTORY_CACHE_SECONDS = int(os.environ.get("HISTORY_CACHE_SECONDS", "60"))
+HISTORY_CACHE_SIZE = int(os.environ.get("HISTORY_CACHE_SIZE", "2000"))
+# زمان باز و بسته شدن تمرین‌ها در هر worker کش می‌شود
+HOMEWORK_CONFIG_CACHE_SECONDS = int(os.environ.get("HOMEWORK_CONFIG_CACHE_SECONDS", "30"))
+# سیاست تصحیح هر سؤال (ترتیب، تلرانس، نام ستون‌ها، سقف ردیف و زمان) در هر worker کش می‌شود
+GRADING_POLICY_CACHE_SECONDS = int(os.environ.get("GRADING_POLICY_CACHE_SECONDS", "60"))
+
+# تعداد دانشجو در هر صفحه مدیریت کاربران
+USERS_PAGE_SIZE = int(os.environ.get("USERS_PAGE_SIZE", "50"))
+
+# محدودیت نرخ (token bucket) به صورت "تعداد/ثانیه"، مثلاً 20/60؛ 0 یعنی غیرفعال.
+# وضعیت bucketها در یک فایل SQLite محلی بین همه workerهای سرور مشترک است.
+RATE_LIMIT_DB = os.environ.get(
+    "RATE_LIMIT_DB", os.path.join(tempfile.gettempdir(), "dbhw-ratelimit.sqlite3")
+)
+RATE_LIMITS = {
+    ("run_test_query", "student"): os.environ.get("RATE_LIMIT_RUN_TEST_QUERY_STUDENT", "20/60"),
+    ("run_test_query", "ip"): os.environ.get("RATE_LIMIT_RUN_TEST_QUERY_IP", "60/60"),
+    ("submit", "student"): os.environ.get("RATE_LIMIT_SUBMIT_STUDENT", "5/60"),
+    ("submit", "ip"): os.environ.get("RATE_LIMIT_SUBMIT_IP", "30/60"),
+}
+# تعداد reverse proxyهای جلوی برنامه؛ برای اینکه محدودیت IP روی IP واقعی کاربر اعمال شود
+PROXY_FIX_HOPS = int(os.environ.get("PROXY_FIX_HOPS", "0"))
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "dev-secret-change-me")
+if PROXY_FIX_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_FIX_HOPS, x_proto=PROXY_FIX_HOPS)
 
 # دکمه‌ها و رشته‌ها
 MAJORS = ["علوم کامپیوتر", "آمار"]
@@ -53,6 +244,11 @@ def utc_to_tehran(utc_dt):
         app.logger.error(f"Error in utc_to_tehran: {e}")
         return utc_dt
 
+def tehran_to_utc(local_dt):
+    """تبدیل زمان واردشده به ساعت تهران (بدون منطقه زمانی) به UTC بدون منطقه زمانی"""
+    tehran_zone = pytz.timezone('Asia/Tehran')
+    return tehran_zone.localize(local_dt).astimezone(pytz.utc).replace(tzinfo=None)
+
 def gregorian_to_jalali_fa(dt):
     """تبدیل تاریخ میلادی به شمسی فارسی"""
     try:
@@ -84,37 +280,2350 @@ def parse_queries(sql_text: str):
     queries = [q.strip().rstrip(";") + ";" for q in splits if q.strip()]
     return queries
 
+def count_submissions(conn, student_id: str, hw: str) -> int:
+    result = conn.execute(
+        text("""
+            SELECT COUNT(*) 
+            FROM student_results 
+            WHERE student_id = :student_id AND hw = :hw
+        """),
+        {"student_id": student_id, "hw": hw},
+    ).fetchone()
+    return int(result[0]) if result else 0
+
 def get_submission_count(student_id: str, hw: str) -> int:
     try:
         with engine.begin() as conn:
-            result = conn.execute(
-                text("""
-                    SELECT COUNT(*) 
-                    FROM student_results 
-                    WHERE student_id = :student_id AND hw = :hw
-                """),
-                {"student_id": student_id, "hw": hw},
-            ).fetchone()
-            return int(result[0]) if result else 0
+            return count_submissions(conn, student_id, hw)
     except Exception as e:
         app.logger.error(f"Error getting submission count: {e}")
         return 0
 
+_ensured_tables = set()
+
+def ensure_once(ensure):
+    """تابع ensure_* (CREATE TABLE IF NOT EXISTS و ...) را در هر پردازه فقط تا اولین commit موفق اجرا می‌کند.
+
+    اجرای دوباره آنها در هر درخواست چند دستور بی‌اثر به هر ارسال اضافه می‌کرد و هشدار
+    QUERY_BUDGET را بی‌معنی می‌کرد. پرچم پس از commit تراکنش گذاشته می‌شود، چون در
+    Postgres با rollback تراکنش DDL هم برمی‌گردد.
+    """
+    @wraps(ensure)
+    def wrapper(conn, *args, **kwargs):
+        if ensure.__name__ in _ensured_tables:
+            return
+        ensure(conn, *args, **kwargs)
+        event.listen(conn, "commit", lambda _: _ensured_tables.add(ensure.__name__), once=True)
+    return wrapper
+
+@ensure_once
+def ensure_gradebook_table(conn):
+    """ایجاد جدول دفتر نمره (یک ردیف برای هر دانشجو و هر تمرین)"""
+    conn.execute(text(
+        """
+        CREATE TABLE IF NOT EXISTS gradebook (
+            student_id TEXT NOT NULL,
+            hw TEXT NOT NULL,
+            name TEXT NOT NULL,
+            major TEXT NOT NULL,
+            best_correct INTEGER NOT NULL,
+            latest_correct INTEGER NOT NULL,
+            attempts INTEGER NOT NULL,
+            last_submission TIMESTAMP,
+            PRIMARY KEY (student_id, hw)
+        )
+        """
+    ))
+
+def upsert_gradebook(conn, student_id: str, name: str, major: str, hw: str, correct_count: int):
+    """به‌روزرسانی افزایشی دفتر نمره پس از هر ارسال"""
+    conn.execute(
+        text("""
+            INSERT INTO gradebook
+                (student_id, hw, name, major, best_correct, latest_correct, attempts, last_submission)
+            VALUES (:student_id, :hw, :name, :major, :correct_count, :correct_count, 1, CURRENT_TIMESTAMP)
+            ON CONFLICT (student_id, hw) DO UPDATE SET
+                name = excluded.name,
+                major = excluded.major,
+                best_correct = CASE WHEN excluded.best_correct > gradebook.best_correct
+                                    THEN excluded.best_correct ELSE gradebook.best_correct END,
+                latest_correct = excluded.latest_correct,
+                attempts = gradebook.attempts + 1,
+                last_submission = excluded.last_submission
+        """),
+        {"student_id": student_id, "hw": hw, "name": name, "major": major, "correct_count": correct_count},
+    )
+
+def refresh_gradebook(conn) -> int:
+    """بازسازی کامل دفتر نمره از روی student_results"""
+    ensure_gradebook_table(conn)
+    conn.execute(text("DELETE FROM gradebook"))
+    result = conn.execute(text(
+        """
+        INSERT INTO gradebook
+            (student_id, hw, name, major, best_correct, latest_correct, attempts, last_submission)
+        SELECT student_id, hw, name, major, best_correct, correct_count, attempts, submission_time
+        FROM (
+            SELECT student_id, hw, name, major, correct_count, submission_time,
+                   MAX(correct_count) OVER (PARTITION BY student_id, hw) AS best_correct,
+                   COUNT(*) OVER (PARTITION BY student_id, hw) AS attempts,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY student_id, hw ORDER BY submission_time DESC, id DESC
+                   ) AS rn
+            FROM student_results
+        ) ranked
+        WHERE rn = 1
+        """
+    ))
+    return result.rowcount
+
+def load_gradebook(mode: str = "best", major: str = ""):
+    """خواندن دفتر نمره به صورت یک ردیف برای هر دانشجو و یک ستون برای هر تمرین"""
+    column = "latest_correct" if mode == "latest" else "best_correct"
+    query = f"SELECT student_id, name, major, hw, {column} FROM gradebook"
+    params = {}
+    if major:
+        query += " WHERE major = :major"
+        params["major"] = major
+    query += " ORDER BY student_id"
+
+    with engine.begin() as conn:
+        ensure_gradebook_table(conn)
+        rows = conn.execute(text(query), params).fetchall()
+
+    students = {}
+    for student_id, name, student_major, hw, score in rows:
+        entry = students.setdefault(student_id, {
+            "student_id": student_id,
+            "name": name,
+            "major": student_major,
+            "scores": {},
+        })
+        entry["scores"][hw] = score
+    return list(students.values())
+
+def apply_statement_guards(conn, read_only: bool = False, timeout_ms: int = 0):
+    """تراکنش جاری را فقط‌خواندنی و دارای محدودیت زمان اجرا می‌کند"""
+    dialect = conn.dialect.name
+    if dialect == "postgresql":
+        if read_only:
+            # باید اولین دستور تراکنش باشد
+            conn.execute(text("SET TRANSACTION READ ONLY"))
+    elif dialect == "sqlite":
+        if read_only:
+            conn.exec_driver_sql("PRAGMA query_only = ON")
+    if timeout_ms:
+        set_statement_timeout(conn, timeout_ms)
+
+def set_statement_timeout(conn, timeout_ms: int):
+    """محدودیت زمان دستورهای بعدی تراکنش جاری؛ 0 یعنی بدون محدودیت.
+
+    در Postgres برای هر دستور جدا و در SQLite از همین لحظه برای همه دستورهای بعدی.
+    """
+    dialect = conn.dialect.name
+    if dialect == "postgresql":
+        conn.execute(text(f"SET LOCAL statement_timeout = {int(timeout_ms)}"))
+    elif dialect == "sqlite":
+        driver = conn.connection.driver_connection
+        # progress handler در aiosqlite async است و این‌جا تنظیم نمی‌شود
+        if not isinstance(driver, sqlite3.Connection):
+            return
+        if not timeout_ms:
+            driver.set_progress_handler(None, 0)
+            return
+        # SQLite statement_timeout ندارد؛ progress handler پس از مهلت کوئری را قطع می‌کند
+        deadline = time.monotonic() + timeout_ms / 1000
+        driver.set_progress_handler(lambda: 1 if time.monotonic() > deadline else 0, 10000)
+
+@contextmanager
+def guarded_connection(bind, read_only: bool = False, timeout_ms: int = 0, commit: bool = True):
+    """اتصال در یک تراکنش محافظت‌شده؛ با commit=False همه تغییرات برگردانده می‌شوند"""
+    with bind.connect() as conn:
+        trans = conn.begin()
+        try:
+            apply_statement_guards(conn, read_only, timeout_ms)
+            yield conn
+            if commit:
+                trans.commit()
+            else:
+                trans.rollback()
+        except Exception:
+            trans.rollback()
+            raise
+        finally:
+            if conn.dialect.name == "sqlite":
+                # PRAGMA و progress handler روی خود اتصال می‌مانند؛ قبل از برگشت به pool پاک شوند
+                if read_only:
+                    conn.exec_driver_sql("PRAGMA query_only = OFF")
+                if timeout_ms:
+                    conn.connection.driver_connection.set_progress_handler(None, 0)
+
+def is_select_statement(query_text: str) -> bool:
+    """آیا دستور ردیف برمی‌گرداند و می‌توان آن را با cursor سمت سرور خواند"""
+    return re.match(r"^\s*(select|with|values|table)\b", query_text, re.IGNORECASE) is not None
+
+def explain_query(conn, query_text: str, analyze: bool = False):
+    """برگرداندن خطوط plan اجرای یک کوئری"""
+    query_text = query_text.strip().rstrip(";")
+    if conn.dialect.name == "postgresql":
+        prefix = "EXPLAIN (ANALYZE, BUFFERS)" if analyze else "EXPLAIN"
+        rows = conn.execute(text(f"{prefix} {query_text}")).fetchall()
+        return [row[0] for row in rows]
+
+    # SQLite فقط EXPLAIN QUERY PLAN دارد: (id, parent, notused, detail)
+    rows = conn.execute(text(f"EXPLAIN QUERY PLAN {query_text}")).fetchall()
+    depth = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node_id] + detail)
+    return lines
+
+def run_console_query(query_text: str, mode: str = "run", read_only: bool = True,
+                      timeout_ms: int = ADMIN_QUERY_TIMEOUT_MS, offset: int = 0,
+                      limit: int = ADMIN_QUERY_ROW_LIMIT):
+    """اجرای کوئری کنسول ادمین با محدودیت تعداد ردیف، زمان‌سنجی و حالت EXPLAIN"""
+    output = {"mode": mode, "offset": offset, "columns": [], "rows": [], "has_more": False, "plan": None}
+    started = time.perf_counter()
+
+    if mode in ("explain", "explain_analyze"):
+        # EXPLAIN ANALYZE کوئری را واقعاً اجرا می‌کند؛ تغییرات آن همیشه برگردانده می‌شود
+        with guarded_connection(engine, read_only, timeout_ms, commit=False) as conn:
+            output["plan"] = explain_query(conn, query_text, analyze=(mode == "explain_analyze"))
+    else:
+        with guarded_connection(engine, read_only, timeout_ms) as conn:
+            stream = is_select_statement(query_text)
+            result = conn.execute(text(query_text), execution_options={"stream_results": stream})
+            if result.returns_rows:
+                output["columns"] = list(result.keys())
+                # رد شدن از ردیف‌های صفحه‌های قبلی بدون نگه‌داشتن آن‌ها در حافظه
+                skipped = 0
+                while skipped < offset:
+                    chunk = result.fetchmany(min(1000, offset - skipped))
+                    if not chunk:
+                        break
+                    skipped += len(chunk)
+                rows = result.fetchmany(limit + 1)
+                output["has_more"] = len(rows) > limit
+                output["rows"] = rows[:limit]
+            else:
+                output["columns"] = None
+                output["rowcount"] = result.rowcount
+            result.close()
+
+    output["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return output
+
+# ==================== بررسی هزینه کوئری پیش از اجرا ====================
+
+class QueryPlanRejected(Exception):
+    """کوئری بر اساس plan تخمینی و پیش از اجرا رد شد"""
+
+def iter_plan_nodes(node):
+    yield node
+    for child in node.get("Plans", []):
+        yield from iter_plan_nodes(child)
+
+def is_unbounded_cross_join(node) -> bool:
+    """nested loop بدون هیچ شرطی که دو طرف را به هم ببندد (ضرب دکارتی)"""
+    if node.get("Node Type") != "Nested Loop" or "Join Filter" in node:
+        return False
+    children = node.get("Plans", [])
+    inner = children[1] if len(children) > 1 else {}
+    if any(key in inner for key in ("Index Cond", "Recheck Cond", "Hash Cond", "Merge Cond")):
+        return False
+    return node.get("Plan Rows", 0) > QUERY_CROSS_JOIN_ROWS
+
+def explain_json(conn, query_text: str):
+    """گره ریشه plan تخمینی Postgres"""
+    raw = conn.execute(text(f"EXPLAIN (FORMAT JSON) {query_text.strip().rstrip(';')}")).scalar()
+    return (json.loads(raw) if isinstance(raw, str) else raw)[0]["Plan"]
+
+def count_nested_full_scans(plan_rows) -> int:
+    """تعداد SCAN کامل جدول که داخل حلقه دیگری اجرا می‌شود، از خروجی EXPLAIN QUERY PLAN.
+
+    حلقه‌های هم‌سطح (SCAN/SEARCH با parent یکسان) به ترتیب داخل هم اجرا می‌شوند و زیرکوئری
+    CORRELATED به ازای هر ردیف حلقه‌های قبلی خودش؛ بقیه (COMPOUND، LIST SUBQUERY،
+    MATERIALIZE و ...) یک بار و پشت سر هم اجرا می‌شوند و عمق حلقه را زیاد نمی‌کنند.
+    """
+    depth = {0: 0}
+    loops = {}
+    nested = 0
+    for node_id, parent, _, detail in plan_rows:
+        base = depth.get(parent, 0) + loops.get(parent, 0)
+        if detail.startswith(("SCAN ", "SEARCH ")) and "CONSTANT ROW" not in detail:
+            if base and detail.startswith("SCAN ") and "INDEX" not in detail:
+                nested += 1
+            loops[parent] = loops.get(parent, 0) + 1
+            depth[node_id] = base + 1
+        elif detail.startswith("CORRELATED "):
+            depth[node_id] = base
+        else:
+            depth[node_id] = depth.get(parent, 0)
+    return nested
+
+def plan_rejection_reason(conn, query_text: str):
+    """دلیل رد کوئری بر اساس plan، یا None"""
+    query_text = query_text.strip().rstrip(";")
+    if conn.dialect.name == "postgresql":
+        plan = explain_json(conn, query_text)
+        cost = plan.get("Total Cost", 0)
+        if QUERY_COST_LIMIT and cost > QUERY_COST_LIMIT:
+            return f"هزینه تخمینی کوئری ({cost:,.0f}) از سقف مجاز ({QUERY_COST_LIMIT:,.0f}) بیشتر است."
+        if QUERY_CROSS_JOIN_ROWS and any(is_unbounded_cross_join(node) for node in iter_plan_nodes(plan)):
+            return "کوئری شامل ضرب دکارتی بزرگ (اتصال بدون شرط) است."
+        return None
+
+    # SQLite هزینه عددی ندارد؛ SCAN کامل (بدون ایندکس) جدول‌ها در حلقه‌های تو در تو شمرده می‌شود
+    rows = conn.execute(text(f"EXPLAIN QUERY PLAN {query_text}")).fetchall()
+    full_scans = count_nested_full_scans(rows)
+    if QUERY_MAX_FULL_SCANS and full_scans > QUERY_MAX_FULL_SCANS:
+        return f"کوئری {full_scans} جدول را داخل حلقه‌های تو در تو به طور کامل پیمایش می‌کند."
+    return None
+
+_plan_cache = OrderedDict()
+_plan_cache_lock = threading.Lock()
+
+def plan_cache_key(query_text: str) -> str:
+    """متن کوئری بدون توضیحات و فاصله‌های اضافی. برخلاف normalize_query مقادیر ثابت حفظ
+    می‌شوند، چون هزینه plan به آنها بستگی دارد (LIMIT 10 در برابر LIMIT 100000000)."""
+    without_comments = re.sub(
+        r"('(?:[^']|'')*')|--[^\n]*|/\*.*?\*/",
+        lambda m: m.group(1) or " ", query_text, flags=re.DOTALL,
+    )
+    collapsed = re.sub(r"('(?:[^']|'')*')|\s+", lambda m: m.group(1) or " ", without_comments)
+    return collapsed.strip().rstrip(";").strip()
+
+def guard_query_plan(conn, query_text: str):
+    """رد کوئری پرهزینه پیش از اجرا؛ نتیجه بر اساس متن کوئری (با مقادیر ثابت) در هر worker کش می‌شود"""
+    if not QUERY_PLAN_GUARD:
+        return
+    key = (conn.dialect.name, plan_cache_key(query_text))
+    with _plan_cache_lock:
+        if key in _plan_cache:
+            _plan_cache.move_to_end(key)
+            reason = _plan_cache[key]
+        else:
+            reason = False
+    if reason is False:
+        # خطای EXPLAIN کش نمی‌شود و همان خطا هنگام اجرای کوئری هم رخ می‌دهد
+        reason = plan_rejection_reason(conn, query_text)
+        with _plan_cache_lock:
+            _plan_cache[key] = reason
+            while len(_plan_cache) > QUERY_PLAN_CACHE_SIZE:
+                _plan_cache.popitem(last=False)
+    if reason:
+        raise QueryPlanRejected(reason)
+
+def reference_suffix(major: str) -> str:
+    return "stat" if major == "آمار" else "cs"
+
+def reference_table_name(hw: str, qnum: int, suffix: str) -> str:
+    return f"hw{hw}_q{qnum}_{suffix}_reference"
+
+def fetch_reference_meta(conn, hw: str, suffix: str):
+    """اثر انگشت جدول‌های مرجع یک تمرین به تفکیک شماره سؤال"""
+    ensure_reference_meta_table(conn)
+    return select_reference_meta(conn, hw, suffix)
+
+def select_reference_meta(conn, hw: str, suffix: str):
+    # بدون ساخت جدول؛ snapshot تصحیح فقط‌خواندنی است
+    rows = conn.execute(
+        text("""
+            SELECT qnum, distinct_count, column_count, column_names, content_hash, solution_sql
+            FROM reference_meta WHERE hw = :hw AND suffix = :suffix
+        """),
+        {"hw": hw, "suffix": suffix},
+    ).mappings().all()
+    return {row["qnum"]: row for row in rows}
+
+def load_reference_meta(hw: str, suffix: str):
+    try:
+        with engine.begin() as conn:
+            return fetch_reference_meta(conn, hw, suffix)
+    except Exception as e:
+        app.logger.error(f"Error loading reference meta for hw{hw}: {e}")
+        return {}
+
+def same_column_names(student_names, reference_names) -> bool:
+    # Postgres نام‌های بدون کوتیشن را کوچک می‌کند و SQLite همان‌طور که نوشته شده نگه می‌دارد
+    return [name.lower() for name in student_names] == [name.lower() for name in reference_names]
+
+def matches_reference_meta(conn, student_query: str, meta, reference_table: str,
+                           policy=None) -> bool:
+    """مقایسه خروجی دانشجو با اثر انگشت مرجع بدون اجرای کوئری مرجع.
+
+    ردیف‌ها دسته‌دسته خوانده می‌شوند و به محض اینکه تعداد ردیف‌های یکتا از مرجع
+    (یا کل ردیف‌ها از row_cap سیاست سؤال) بیشتر شود خواندن متوقف می‌شود. فقط اگر
+    تعداد برابر ولی hash متفاوت باشد (مثلاً اختلاف اعشار یا فاصله انتهایی) یا ترتیب
+    مهم باشد، جدول مرجع خوانده و با results_match مقایسه می‌شود.
+    """
+    policy = policy or DEFAULT_GRADING_POLICY
+    # گزینه روی همین دستور؛ conn.execution_options() خود اتصال تصحیح را برای سؤال‌های بعدی هم عوض می‌کند
+    result = conn.execute(text(student_query), execution_options={"stream_results": True})
+    rows = []
+    try:
+        if len(result.keys()) != meta["column_count"]:
+            return False
+        if policy["match_column_names"] and not same_column_names(result.keys(), json.loads(meta["column_names"])):
+            return False
+        fingerprint = ResultFingerprint(meta["column_count"])
+        for partition in result.partitions(1000):
+            for row in partition:
+                fingerprint.add(row)
+            rows.extend(partition)
+            if policy["row_cap"] and fingerprint.row_count > policy["row_cap"]:
+                return False
+            if fingerprint.distinct_count > meta["distinct_count"]:
+                return False
+    finally:
+        result.close()
+    if fingerprint.distinct_count != meta["distinct_count"]:
+        return False
+    if fingerprint.content_hash() == meta["content_hash"] and not policy["order_matters"]:
+        return True
+    if policy["order_matters"] and meta["solution_sql"]:
+        # ترتیب ردیف‌های جدول مرجع (heap) تضمینی ندارد؛ حل رسمی با ORDER BY خودش روی همان
+        # داده‌ای که کوئری دانشجو دیده دوباره اجرا می‌شود
+        reference_rows = conn.execute(text(meta["solution_sql"].strip().rstrip(";"))).fetchall()
+    else:
+        reference_rows = conn.execute(text(f"SELECT * FROM {reference_table}")).fetchall()
+    return results_match(rows, reference_rows, policy["tolerance"], policy["order_matters"])
+
+def matches_reference_table(conn, student_query: str, reference_table: str,
+                            policy=None) -> bool:
+    """مقایسه مستقیم با جدول مرجعی که اثر انگشت ندارد.
+
+    این جدول‌ها حل رسمی ذخیره‌شده ندارند، پس با order_matters ترتیب ردیف‌ها همان ترتیب
+    خواندن جدول است؛ برای سؤال‌های ترتیبی مرجع را از /admin/references بسازید.
+    """
+    policy = policy or DEFAULT_GRADING_POLICY
+    result = conn.execute(text(student_query))
+    if policy["row_cap"]:
+        student_rows = result.fetchmany(policy["row_cap"] + 1)
+        result.close()
+        if len(student_rows) > policy["row_cap"]:
+            return False
+    else:
+        student_rows = result.fetchall()
+    reference = conn.execute(text(f"SELECT * FROM {reference_table}"))
+    if policy["match_column_names"] and not same_column_names(result.keys(), reference.keys()):
+        return False
+    return results_match(student_rows, reference.fetchall(), policy["tolerance"], policy["order_matters"])
+
+def measure_query(conn, query_text: str, deadline: float):
+    """میانه زمان اجرای کوئری (میلی‌ثانیه) پس از اجراهای گرم‌کردن؛ None اگر مهلت کافی نباشد"""
+    samples = []
+    for run in range(EFFICIENCY_WARMUP_RUNS + EFFICIENCY_RUNS):
+        remaining_ms = (deadline - time.monotonic()) * 1000
+        if remaining_ms < 1:
+            break
+        # هر اجرا فقط باقی‌مانده مهلت سنجش را دارد، نه یک GRADING_STATEMENT_TIMEOUT_MS کامل
+        set_statement_timeout(conn, remaining_ms)
+        started = time.perf_counter()
+        conn.execute(text(query_text)).fetchall()
+        if run >= EFFICIENCY_WARMUP_RUNS:
+            samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples) if samples else None
+
+def plan_cost(conn, query_text: str):
+    """Total Cost تخمینی؛ SQLite هزینه عددی ندارد"""
+    if conn.dialect.name != "postgresql":
+        return None
+    return explain_json(conn, query_text).get("Total Cost")
+
+def efficiency_score(student_ms, reference_ms, student_cost, reference_cost):
+    """۰ تا ۱۰۰: نسبت زمان (و در صورت وجود، هزینه plan) حل رسمی به پاسخ دانشجو"""
+    ratios = []
+    if student_ms and reference_ms:
+        ratios.append(min(1.0, reference_ms / student_ms))
+    if student_cost and reference_cost:
+        ratios.append(min(1.0, reference_cost / student_cost))
+    if not ratios:
+        return None
+    return round(100 * sum(ratios) / len(ratios))
+
+# زمان و هزینه حل رسمی هر سؤال؛ با ساخت دوباره جدول مرجع content_hash عوض می‌شود
+_reference_measurements = {}
+
+def measure_efficiency(conn, hw: str, suffix: str, qnum: int, student_query: str, meta, deadline: float):
+    """سنجش کارایی یک پاسخ درست در savepoint جدا؛ خطا یا کمبود مهلت فقط امتیاز را حذف می‌کند"""
+    if not meta or not meta.get("solution_sql"):
+        return {}
+    try:
+        with conn.begin_nested():
+            key = (hw, suffix, qnum, meta["content_hash"], conn.dialect.name)
+            if key not in _reference_measurements:
+                reference_ms = measure_query(conn, meta["solution_sql"], deadline)
+                if reference_ms is None:
+                    return {}
+                _reference_measurements[key] = (reference_ms, plan_cost(conn, meta["solution_sql"]))
+            reference_ms, reference_cost = _reference_measurements[key]
+            student_ms = measure_query(conn, student_query, deadline)
+            student_cost = plan_cost(conn, student_query)
+    except Exception as e:
+        app.logger.warning(f"Efficiency measurement failed for hw{hw} q{qnum}: {e}")
+        return {}
+    return {
+        "student_ms": student_ms,
+        "reference_ms": reference_ms,
+        "student_cost": student_cost,
+        "reference_cost": reference_cost,
+        "efficiency": efficiency_score(student_ms, reference_ms, student_cost, reference_cost),
+    }
+
+def restore_grading_timeout(conn, grading_deadline: float):
+    """مهلت عادی برای سؤال‌های بعدی؛ در SQLite باقی‌مانده مهلت کل تصحیح"""
+    if conn.dialect.name == "sqlite" and GRADING_STATEMENT_TIMEOUT_MS:
+        set_statement_timeout(conn, max(1, (grading_deadline - time.monotonic()) * 1000))
+    else:
+        set_statement_timeout(conn, GRADING_STATEMENT_TIMEOUT_MS)
+
+def grade_submission(conn, hw: str, major: str, queries, reference_meta=None, rejected=None, details=None,
+                     policies=None):
+    """مقایسه خروجی هر کوئری دانشجو با جدول مرجع؛ برگرداندن تعداد درست و شماره سؤال‌های نادرست
+
+    سؤال‌هایی که بررسی plan آنها را رد کند به صورت (شماره، دلیل) به لیست rejected اضافه می‌شوند.
+    اگر details داده شود، نتیجه هر سؤال (و با EFFICIENCY_SCORING امتیاز کارایی) به آن اضافه می‌شود.
+    نحوه مقایسه هر سؤال از سیاست تصحیح آن (کش grading_policies) خوانده می‌شود.
+    """
+    suffix = reference_suffix(major)
+    if reference_meta is None:
+        if GRADING_BACKEND == "snapshot":
+            # اثر انگشت هم مثل جدول‌های مرجع از snapshot؛ تصحیح به دیتابیس اصلی وصل نمی‌شود
+            reference_meta = snapshot_reference_meta(conn, hw, suffix)
+        else:
+            reference_meta = load_reference_meta(hw, suffix)
+    if policies is None:
+        policies = grading_policies.get()
+    correct_count = 0
+    incorrect_questions = []
+    grading_started = time.perf_counter()
+    # زمان‌سنجی نباید مهلت سؤال‌های بعدی را مصرف کند
+    efficiency_deadline = time.monotonic() + GRADING_STATEMENT_TIMEOUT_MS / 2000
+    grading_deadline = time.monotonic() + GRADING_STATEMENT_TIMEOUT_MS / 1000
+
+    for i, student_query in enumerate(queries):
+        qnum = i + 1
+        reference_table = reference_table_name(hw, qnum, suffix)
+        question_started = time.perf_counter()
+        policy = grading_policy(policies, hw, qnum, major)
+        is_correct = False
+        try:
+            if policy["timeout_ms"]:
+                set_statement_timeout(conn, policy["timeout_ms"])
+            # savepoint: خطای یک سؤال تراکنش بقیه سؤال‌ها را خراب نمی‌کند
+            with conn.begin_nested():
+                guard_query_plan(conn, student_query)
+                meta = reference_meta.get(qnum)
+                if meta is not None:
+                    # جدول مرجع از صفحه حل رسمی ساخته شده؛ اثر انگشت معمولاً برای تصمیم کافی است
+                    is_correct = matches_reference_meta(conn, student_query, meta, reference_table, policy)
+                else:
+                    is_correct = matches_reference_table(conn, student_query, reference_table, policy)
+            if is_correct:
+                correct_count += 1
+                GRADED_QUESTIONS.labels(hw, "correct").inc()
+            else:
+                incorrect_questions.append(qnum)
+                GRADED_QUESTIONS.labels(hw, "wrong").inc()
+        except QueryPlanRejected as e:
+            incorrect_questions.append(qnum)
+            GRADED_QUESTIONS.labels(hw, "rejected").inc()
+            if rejected is not None:
+                rejected.append((qnum, str(e)))
+        except Exception as e:
+            app.logger.error(f"Error executing q{qnum}: {e}")
+            incorrect_questions.append(qnum)
+            GRADED_QUESTIONS.labels(hw, "error").inc()
+        if policy["timeout_ms"]:
+            restore_grading_timeout(conn, grading_deadline)
+        GRADING_QUESTION_SECONDS.labels(hw, major).observe(time.perf_counter() - question_started)
+
+        if details is not None:
+            detail = {"qnum": qnum, "correct": is_correct}
+            if is_correct and EFFICIENCY_SCORING:
+                detail.update(measure_efficiency(
+                    conn, hw, suffix, qnum, student_query, reference_meta.get(qnum), efficiency_deadline
+                ))
+                # measure_query مهلت را به باقی‌مانده زمان سنجش کوتاه کرده است
+                restore_grading_timeout(conn, grading_deadline)
+            details.append(detail)
+
+    GRADING_SUBMISSION_SECONDS.labels(hw, major).observe(time.perf_counter() - grading_started)
+    return correct_count, incorrect_questions
+
+def find_student(conn, student_id: str, password: str):
+    """نام و رشته دانشجو در صورت درست بودن پسورد، وگرنه (None, None)"""
+    row = conn.execute(
+        text("SELECT name, major FROM stuid WHERE student_id=:sid AND pass=:pwd"),
+        {"sid": student_id, "pwd": password}
+    ).fetchone()
+    if row:
+        return row[0], row[1]  # name, major
+    return None, None
+
 def authenticate(student_id: str, password: str):
     """بررسی شماره دانشجویی و پسورد و برگرداندن نام و رشته"""
     try:
         with engine.begin() as conn:
-            row = conn.execute(
-                text("SELECT name, major FROM stuid WHERE student_id=:sid AND pass=:pwd"),
-                {"sid": student_id, "pwd": password}
-            ).fetchone()
-            if row:
-                return row[0], row[1]  # name, major
-            return None, None
+            return find_student(conn, student_id, password)
     except Exception as e:
         app.logger.error(f"Auth error: {e}")
         return None, None
 
+def efficiency_summary(details):
+    """خلاصه کوچک امتیاز کارایی برای session و result.html"""
+    return [
+        {
+            "qnum": d["qnum"],
+            "score": d["efficiency"],
+            "student_ms": round(d["student_ms"], 2),
+            "reference_ms": round(d["reference_ms"], 2),
+        }
+        for d in details or []
+        if d.get("efficiency") is not None
+    ]
+
+@ensure_once
+def ensure_question_results_table(conn):
+    conn.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS question_results (
+            {serial_pk(conn)},
+            result_id INTEGER NOT NULL,
+            student_id TEXT NOT NULL,
+            hw TEXT NOT NULL,
+            qnum INTEGER NOT NULL,
+            correct BOOLEAN NOT NULL,
+            student_ms REAL,
+            reference_ms REAL,
+            student_cost REAL,
+            reference_cost REAL,
+            efficiency INTEGER
+        )
+    """))
+
+@ensure_once
+def ensure_student_results_table(conn):
+    # در SQLite فقط INTEGER PRIMARY KEY مقدار خودافزا دارد و RETURNING id را پر می‌کند
+    conn.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS student_results (
+            {serial_pk(conn)},
+            student_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            major TEXT NOT NULL,
+            hw TEXT NOT NULL,
+            correct_count INTEGER NOT NULL,
+            submission_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+
+def record_submission(conn, student_id: str, name: str, major: str, hw: str, correct_count: int,
+                      details=None):
+    """ثبت نتیجه ارسال در student_results (و در صورت وجود، نتیجه هر سؤال) و به‌روزرسانی دفتر نمره"""
+    ensure_student_results_table(conn)
+
+    result_id = conn.execute(
+        text(
+            "INSERT INTO student_results (student_id, name, major, hw, correct_count) "
+            "VALUES (:student_id, :name, :major, :hw, :correct_count) RETURNING id"
+        ),
+        {"student_id": student_id, "name": name, "major": major, "hw": hw, "correct_count": correct_count},
+    ).scalar()
+
+    if details:
+        ensure_question_results_table(conn)
+        conn.execute(
+            text("""
+                INSERT INTO question_results
+                    (result_id, student_id, hw, qnum, correct, student_ms, reference_ms,
+                     student_cost, reference_cost, efficiency)
+                VALUES (:result_id, :student_id, :hw, :qnum, :correct, :student_ms, :reference_ms,
+                        :student_cost, :reference_cost, :efficiency)
+            """),
+            [
+                {
+                    "result_id": result_id, "student_id": student_id, "hw": hw,
+                    "student_ms": None, "reference_ms": None, "student_cost": None,
+                    "reference_cost": None, "efficiency": None, **detail,
+                }
+                for detail in details
+            ],
+        )
+
+    ensure_gradebook_table(conn)
+    upsert_gradebook(conn, student_id, name, major, hw, correct_count)
+
+def serial_pk(conn) -> str:
+    """ستون کلید خودافزا متناسب با نوع دیتابیس"""
+    if conn.dialect.name == "sqlite":
+        return "id INTEGER PRIMARY KEY AUTOINCREMENT"
+    return "id SERIAL PRIMARY KEY"
+
+class BufferedInserter:
+    """ردیف‌ها را در حافظه جمع می‌کند و در یک thread پس‌زمینه به صورت دسته‌ای درج می‌کند.
+
+    درج وقتی انجام می‌شود که تعداد ردیف‌ها به max_batch برسد یا flush_interval
+    ثانیه بگذرد، پس درخواست‌ها منتظر نوشتن در دیتابیس نمی‌مانند.
+    """
+
+    def __init__(self, name, insert_sql, ensure_table=None,
+                 max_batch=LOG_FLUSH_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL_SECONDS):
+        self.name = name
+        self.insert_sql = insert_sql
+        self.ensure_table = ensure_table
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        # اگر دیتابیس در دسترس نباشد بافر بی‌نهایت بزرگ نمی‌شود
+        self.max_pending = max_batch * 20
+        self._rows = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._table_ready = False
+
+    def add(self, row: dict):
+        with self._lock:
+            if len(self._rows) >= self.max_pending:
+                self._rows.pop(0)
+            self._rows.append(row)
+            if len(self._rows) >= self.max_batch:
+                self._wakeup.set()
+        self._ensure_thread()
+
+    def _ensure_thread(self):
+        # بعد از fork، thread پردازه والد در فرزند وجود ندارد
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-flusher", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if not rows:
+            return
+        try:
+            with engine.begin() as conn:
+                if self.ensure_table and not self._table_ready:
+                    self.ensure_table(conn)
+                    self._table_ready = True
+                conn.execute(text(self.insert_sql), rows)
+        except Exception as e:
+            app.logger.error(f"Error flushing {self.name} ({len(rows)} rows dropped): {e}")
+
+# ==================== تاریخچه کوئری‌های کنسول ادمین ====================
+
+def normalize_query(query_text: str) -> str:
+    """حذف توضیحات و مقادیر ثابت تا کوئری‌های هم‌شکل یکی شمرده شوند"""
+    normalized = re.sub(r"--[^\n]*", " ", query_text)
+    normalized = re.sub(r"/\*.*?\*/", " ", normalized, flags=re.DOTALL)
+    normalized = re.sub(r"'(?:[^']|'')*'", "?", normalized)
+    normalized = re.sub(r"\b\d+(?:\.\d+)?\b", "?", normalized)
+    normalized = re.sub(r"\s+", " ", normalized).strip().rstrip(";").strip()
+    return normalized.lower()
+
+def query_fingerprint(query_text: str) -> str:
+    return hashlib.sha1(normalize_query(query_text).encode("utf-8")).hexdigest()[:16]
+
+@ensure_once
+def ensure_query_log_tables(conn):
+    conn.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS admin_query_log (
+            {serial_pk(conn)},
+            query_hash TEXT NOT NULL,
+            normalized_query TEXT NOT NULL,
+            query_text TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            duration_ms REAL NOT NULL,
+            row_count INTEGER,
+            error TEXT,
+            executed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS idx_admin_query_log_hash ON admin_query_log (query_hash)"
+    ))
+    conn.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS admin_saved_queries (
+            {serial_pk(conn)},
+            name TEXT NOT NULL UNIQUE,
+            query_text TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+
+query_log_writer = BufferedInserter(
+    "admin_query_log",
+    """
+    INSERT INTO admin_query_log
+        (query_hash, normalized_query, query_text, mode, duration_ms, row_count, error)
+    VALUES (:query_hash, :normalized_query, :query_text, :mode, :duration_ms, :row_count, :error)
+    """,
+    ensure_table=ensure_query_log_tables,
+)
+atexit.register(query_log_writer.flush)
+
+def record_console_query(query_text: str, mode: str, duration_ms: float, row_count, error=None):
+    """ثبت یک اجرای کنسول در بافر؛ نوشتن در دیتابیس در پس‌زمینه انجام می‌شود"""
+    audit("console_query", mode=mode, query_hash=query_fingerprint(query_text),
+          row_count=row_count, error=str(error)[:200] if error else None)
+    query_log_writer.add({
+        "query_hash": query_fingerprint(query_text),
+        "normalized_query": normalize_query(query_text),
+        "query_text": query_text,
+        "mode": mode,
+        "duration_ms": duration_ms,
+        "row_count": row_count,
+        "error": str(error)[:1000] if error else None,
+    })
+
+def load_console_history(limit: int = 20):
+    """کوئری‌های ذخیره‌شده و کندترین کوئری‌ها برای صفحه کنسول"""
+    with engine.begin() as conn:
+        ensure_query_log_tables(conn)
+        saved = conn.execute(text(
+            "SELECT id, name, query_text FROM admin_saved_queries ORDER BY name"
+        )).mappings().all()
+        slowest = conn.execute(text("""
+            SELECT query_hash,
+                   MAX(query_text) AS query_text,
+                   MAX(normalized_query) AS normalized_query,
+                   COUNT(*) AS runs,
+                   AVG(duration_ms) AS avg_ms,
+                   MAX(duration_ms) AS max_ms,
+                   SUM(CASE WHEN error IS NULL THEN 0 ELSE 1 END) AS errors,
+                   MAX(executed_at) AS last_run
+            FROM admin_query_log
+            GROUP BY query_hash
+            ORDER BY avg_ms DESC
+            LIMIT :limit
+        """), {"limit": limit}).mappings().all()
+    return saved, slowest
+
+# ==================== لاگ رویدادها (audit) ====================
+
+@ensure_once
+def ensure_audit_table(conn):
+    conn.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS audit_events (
+            {serial_pk(conn)},
+            event_type TEXT NOT NULL,
+            actor TEXT,
+            actor_role TEXT,
+            target TEXT,
+            ip TEXT,
+            details TEXT,
+            created_at TIMESTAMP NOT NULL
+        )
+    """))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS idx_audit_events_type_time ON audit_events (event_type, created_at)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS idx_audit_events_actor_time ON audit_events (actor, created_at)"
+    ))
+
+audit_writer = BufferedInserter(
+    "audit_events",
+    """
+    INSERT INTO audit_events (event_type, actor, actor_role, target, ip, details, created_at)
+    VALUES (:event_type, :actor, :actor_role, :target, :ip, :details, :created_at)
+    """,
+    ensure_table=ensure_audit_table,
+)
+atexit.register(audit_writer.flush)
+
+def audit(event_type: str, target=None, actor=None, role=None, ip=None, **details):
+    """ثبت یک رویداد در بافر؛ فقط اضافه می‌شود و در پس‌زمینه دسته‌ای نوشته می‌شود.
+
+    کاربر و IP از درخواست جاری خوانده می‌شوند مگر اینکه صریحاً داده شوند
+    (مثلاً شماره دانشجویی واردشده در ورود ناموفق).
+    """
+    if has_request_context():
+        is_admin_route = request.path.startswith("/admin")
+        if role is None:
+            role = "admin" if is_admin_route else "student"
+        if actor is None:
+            actor = session.get("admin_username", "admin") if is_admin_route else session.get("student_id")
+        if ip is None:
+            ip = request.remote_addr
+    audit_writer.add({
+        "event_type": event_type,
+        "actor": actor,
+        "actor_role": role,
+        "target": None if target is None else str(target),
+        "ip": ip,
+        "details": json.dumps(details, ensure_ascii=False, default=str) if details else None,
+        # بافر ممکن است چند ثانیه بعد نوشته شود؛ زمان رویداد همین‌جا ثبت می‌شود
+        "created_at": datetime.utcnow(),
+    })
+
+# ==================== ورود گروهی دانشجویان ====================
+
+ROSTER_FIELDS = ("student_id", "name", "major", "email", "password")
+STUDENT_ID_RE = re.compile(r"^[0-9A-Za-z_-]{1,32}$")
+EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+def validate_roster_row(row: dict):
+    """بررسی یک ردیف CSV؛ برگرداندن (رکورد، None) یا (None, پیام خطا)"""
+    values = {field: (row.get(field) or "").strip() for field in ROSTER_FIELDS}
+    if not STUDENT_ID_RE.match(values["student_id"]):
+        return None, "شماره دانشجویی نامعتبر است"
+    if not values["name"]:
+        return None, "نام خالی است"
+    if values["major"] not in MAJORS:
+        return None, f"رشته '{values['major']}' معتبر نیست"
+    if values["email"] and not EMAIL_RE.match(values["email"]):
+        return None, "ایمیل نامعتبر است"
+    if not values["password"]:
+        return None, "رمز عبور خالی است"
+    return {
+        "student_id": values["student_id"],
+        "name": values["name"],
+        "major": values["major"],
+        "email": values["email"] or None,
+        "pass": values["password"],
+    }, None
+
+def upsert_students(conn, records):
+    """درج یا به‌روزرسانی یک دسته دانشجو با یک دستور INSERT چندردیفی"""
+    placeholders = []
+    params = {}
+    for i, record in enumerate(records):
+        placeholders.append(f"(:student_id_{i}, :name_{i}, :major_{i}, :email_{i}, :pass_{i})")
+        for key, value in record.items():
+            params[f"{key}_{i}"] = value
+    # ON CONFLICT به کلید یکتای stuid.student_id نیاز دارد
+    conn.execute(
+        text(f"""
+            INSERT INTO stuid (student_id, name, major, email, pass)
+            VALUES {", ".join(placeholders)}
+            ON CONFLICT (student_id) DO UPDATE SET
+                name = excluded.name,
+                major = excluded.major,
+                email = COALESCE(excluded.email, stuid.email),
+                pass = excluded.pass
+        """),
+        params,
+    )
+
+def import_roster(stream):
+    """خواندن CSV به صورت جریانی و درج دسته‌ای؛ برگرداندن (تعداد واردشده، لیست خطاها)
+
+    همه دسته‌ها در یک تراکنش درج می‌شوند؛ ردیف‌های نامعتبر کنار گذاشته و گزارش می‌شوند.
+    """
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""))
+    missing = [field for field in ROSTER_FIELDS if field not in (reader.fieldnames or [])]
+    if missing:
+        raise ValueError(f"ستون‌های {', '.join(missing)} در فایل وجود ندارند")
+
+    imported = 0
+    errors = []
+    seen = set()
+    batch = []
+    with engine.begin() as conn:
+        for line_no, row in enumerate(reader, start=2):
+            record, error = validate_roster_row(row)
+            if record and record["student_id"] in seen:
+                record, error = None, "شماره دانشجویی تکراری در فایل"
+            if error:
+                errors.append({"line": line_no, "student_id": (row.get("student_id") or "").strip(), "error": error})
+                continue
+            seen.add(record["student_id"])
+            batch.append(record)
+            if len(batch) >= ROSTER_BATCH_SIZE:
+                upsert_students(conn, batch)
+                imported += len(batch)
+                batch = []
+        if batch:
+            upsert_students(conn, batch)
+            imported += len(batch)
+    return imported, errors
+
+# ==================== جستجو و صفحه‌بندی کاربران ====================
+
+_user_indexes_ready = False
+
+def ensure_user_indexes(conn):
+    """ایندکس‌های جستجوی پیشوندی نام/شماره دانشجویی و فیلتر رشته (یک بار در هر پردازه)"""
+    global _user_indexes_ready
+    if _user_indexes_ready:
+        return
+    if conn.dialect.name == "postgresql":
+        # text_pattern_ops برای LIKE 'prefix%' مستقل از collation دیتابیس لازم است
+        statements = [
+            "CREATE INDEX IF NOT EXISTS idx_stuid_name_prefix ON stuid (name text_pattern_ops)",
+            "CREATE INDEX IF NOT EXISTS idx_stuid_student_id_prefix ON stuid (student_id text_pattern_ops)",
+            "CREATE INDEX IF NOT EXISTS idx_stuid_major_student_id ON stuid (major, student_id)",
+        ]
+    else:
+        # LIKE در SQLite به حروف حساس نیست و فقط از ایندکس NOCASE استفاده می‌کند
+        statements = [
+            "CREATE INDEX IF NOT EXISTS idx_stuid_name_nocase ON stuid (name COLLATE NOCASE)",
+            "CREATE INDEX IF NOT EXISTS idx_stuid_student_id_nocase ON stuid (student_id COLLATE NOCASE)",
+            "CREATE INDEX IF NOT EXISTS idx_stuid_major_student_id ON stuid (major, student_id)",
+        ]
+    try:
+        with conn.begin_nested():
+            for statement in statements:
+                conn.execute(text(statement))
+        _user_indexes_ready = True
+    except Exception as e:
+        app.logger.error(f"Error creating stuid indexes: {e}")
+
+def user_filter_clause(q: str = "", major: str = ""):
+    """شرط WHERE برای جستجوی پیشوندی شماره دانشجویی یا نام و فیلتر رشته"""
+    conditions = []
+    params = {}
+    if q:
+        if re.search(r"[\\%_]", q):
+            escaped = q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            conditions.append("(student_id LIKE :prefix ESCAPE '\\' OR name LIKE :prefix ESCAPE '\\')")
+        else:
+            # بدون ESCAPE تا SQLite هم بتواند از ایندکس برای LIKE پیشوندی استفاده کند
+            escaped = q
+            conditions.append("(student_id LIKE :prefix OR name LIKE :prefix)")
+        params["prefix"] = escaped + "%"
+    if major:
+        conditions.append("major = :major")
+        params["major"] = major
+    return (" AND ".join(conditions) or "1=1"), params
+
+def fetch_users(q: str = "", major: str = "", after: str = "", limit: int = USERS_PAGE_SIZE):
+    """یک صفحه از دانشجویان با صفحه‌بندی keyset روی student_id؛ برگرداندن (ردیف‌ها، کلید صفحه بعد)"""
+    where, params = user_filter_clause(q, major)
+    if after:
+        where += " AND student_id > :after"
+        params["after"] = after
+    params["limit"] = limit + 1
+
+    with engine.begin() as conn:
+        ensure_user_indexes(conn)
+        rows = conn.execute(
+            text(f"""
+                SELECT student_id, name, major, email FROM stuid
+                WHERE {where}
+                ORDER BY student_id
+                LIMIT :limit
+            """),
+            params,
+        ).mappings().all()
+
+    users = [dict(row) for row in rows[:limit]]
+    next_after = users[-1]["student_id"] if len(rows) > limit else None
+    return users, next_after
+
+# ==================== تاریخچه ارسال‌های دانشجو ====================
+
+_results_index_ready = False
+
+def ensure_results_index(conn):
+    """ایندکس (student_id, hw, submission_time) برای خواندن تاریخچه یک دانشجو (یک بار در هر پردازه)"""
+    global _results_index_ready
+    if _results_index_ready:
+        return
+    try:
+        with conn.begin_nested():
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS idx_student_results_student_hw_time "
+                "ON student_results (student_id, hw, submission_time)"
+            ))
+        # فقط پس از موفقیت؛ مثلاً اگر student_results هنوز ساخته نشده، درخواست بعدی دوباره تلاش می‌کند
+        _results_index_ready = True
+    except Exception as e:
+        app.logger.error(f"Error creating student_results index: {e}")
+
+def fetch_student_history(conn, student_id: str):
+    """همه ارسال‌های یک دانشجو به تفکیک تمرین، همراه با بهترین نمره و سهمیه باقی‌مانده"""
+    ensure_results_index(conn)
+    rows = conn.execute(
+        text("""
+            SELECT hw, correct_count, submission_time
+            FROM student_results
+            WHERE student_id = :student_id
+            ORDER BY hw, submission_time DESC
+        """),
+        {"student_id": student_id},
+    ).fetchall()
+
+    history = {hw: [] for hw in HW_NUMBERS}
+    for hw, correct_count, submission_time in rows:
+        history.setdefault(hw, []).append({
+            "correct": correct_count,
+            "time_fa": format_datetime_fa(submission_time),
+        })
+
+    summary = []
+    for hw, attempts in history.items():
+        summary.append({
+            "hw": hw,
+            "attempts": attempts,
+            "best": max((a["correct"] for a in attempts), default=None),
+            # سهمیه از همین خواندن حساب می‌شود، نه با COUNT جداگانه
+            "remaining": max(MAX_SUBMISSIONS - len(attempts), 0),
+        })
+    return summary
+
+class HistoryCache:
+    """کش LRU کوچک با انقضای زمانی برای خلاصه تاریخچه هر دانشجو.
+
+    ارسال جدید در همین worker ورودی را حذف می‌کند و شماره نسخه در session دانشجو
+    ارسال‌هایی را که در workerهای دیگر ثبت شده‌اند پوشش می‌دهد.
+    """
+
+    def __init__(self, ttl: int, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, student_id: str, version: int):
+        with self._lock:
+            entry = self._entries.get(student_id)
+            if entry is None:
+                return None
+            entry_version, expires_at, value = entry
+            if entry_version != version or expires_at < time.monotonic():
+                del self._entries[student_id]
+                return None
+            self._entries.move_to_end(student_id)
+            return value
+
+    def put(self, student_id: str, version: int, value):
+        with self._lock:
+            self._entries[student_id] = (version, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(student_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, student_id: str):
+        with self._lock:
+            self._entries.pop(student_id, None)
+
+history_cache = HistoryCache(HISTORY_CACHE_SECONDS, HISTORY_CACHE_SIZE)
+
+def invalidate_student_history(student_id: str):
+    """پس از هر ارسال: حذف از کش همین worker و بالا بردن نسخه در session"""
+    history_cache.invalidate(student_id)
+    if has_request_context():
+        session["history_version"] = session.get("history_version", 0) + 1
+
+def load_student_history(student_id: str):
+    version = session.get("history_version", 0)
+    summary = history_cache.get(student_id, version)
+    if summary is None:
+        with engine.begin() as conn:
+            summary = fetch_student_history(conn, student_id)
+        history_cache.put(student_id, version, summary)
+    return summary
+
+# ==================== کش جدول‌های تنظیمات ====================
+
+class TableCache:
+    """یک جدول کوچک تنظیمات در حافظه هر worker.
+
+    loader(conn) هر ttl ثانیه یک بار (یا پس از invalidate) روی engine اصلی اجرا می‌شود؛
+    تغییر در worker دیگر حداکثر پس از ttl ثانیه دیده می‌شود. اگر دیتابیس در دسترس
+    نباشد آخرین مقدار (یا default()) برگردانده می‌شود.
+    """
+
+    def __init__(self, name, loader, ttl, default):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.default = default
+        self._value = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._loaded_at is not None and now - self._loaded_at < self.ttl:
+                return self._value
+        try:
+            with engine.begin() as conn:
+                value = self.loader(conn)
+        except Exception as e:
+            app.logger.error(f"Error loading {self.name}: {e}")
+            value = self._value if self._value is not None else self.default()
+        with self._lock:
+            self._value, self._loaded_at = value, now
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+# ==================== زمان‌بندی تمرین‌ها ====================
+
+@ensure_once
+def ensure_homework_config_table(conn):
+    # زمان‌ها به UTC ذخیره می‌شوند؛ NULL یعنی بدون محدودیت از آن سمت
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS homework_config (
+            hw TEXT PRIMARY KEY,
+            opens_at TIMESTAMP,
+            closes_at TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+    for hw in HW_NUMBERS:
+        conn.execute(
+            text("INSERT INTO homework_config (hw) VALUES (:hw) ON CONFLICT (hw) DO NOTHING"),
+            {"hw": hw},
+        )
+
+def as_datetime(value):
+    """SQLite زمان‌ها را به صورت رشته برمی‌گرداند"""
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value))
+
+def fetch_homework_config(conn):
+    ensure_homework_config_table(conn)
+    rows = conn.execute(text("SELECT hw, opens_at, closes_at FROM homework_config")).fetchall()
+    return {row.hw: (as_datetime(row.opens_at), as_datetime(row.closes_at)) for row in rows}
+
+# hw -> (opens_at, closes_at)؛ اگر دیتابیس در دسترس نباشد بدون محدودیت زمانی
+homework_config = TableCache(
+    "homework config", fetch_homework_config, HOMEWORK_CONFIG_CACHE_SECONDS,
+    lambda: {hw: (None, None) for hw in HW_NUMBERS},
+)
+
+def homework_status(hw: str, now=None):
+    """'open'، 'not_open'، 'closed' یا None برای تمرین ناشناخته"""
+    if hw not in HW_NUMBERS:
+        return None
+    opens_at, closes_at = homework_config.get().get(hw, (None, None))
+    now = now or datetime.utcnow()
+    if opens_at is not None and now < opens_at:
+        return "not_open"
+    if closes_at is not None and now >= closes_at:
+        return "closed"
+    return "open"
+
+def open_homeworks(now=None):
+    """تمرین‌های باز به ترتیب HW_NUMBERS همراه با مهلت هر کدام"""
+    now = now or datetime.utcnow()
+    config = homework_config.get()
+    return [(hw, config.get(hw, (None, None))[1]) for hw in HW_NUMBERS if homework_status(hw, now) == "open"]
+
+HOMEWORK_CLOSED_MESSAGES = {
+    "not_open": "ارسال تمرین {hw} هنوز باز نشده است.",
+    "closed": "مهلت ارسال تمرین {hw} به پایان رسیده است.",
+}
+
+def homework_priority(hw: str) -> float:
+    """کلید صف تصحیح: تمرینی که مهلتش زودتر تمام می‌شود زودتر تصحیح می‌شود"""
+    closes_at = homework_config.get().get(hw, (None, None))[1]
+    return closes_at.replace(tzinfo=pytz.utc).timestamp() if closes_at else math.inf
+
+# ==================== سیاست تصحیح هر سؤال ====================
+
+# مقدار NULL هر ستون سیاست یعنی همین پیش‌فرض
+DEFAULT_GRADING_POLICY = {
+    "order_matters": False,
+    "tolerance": COMPARE_FLOAT_TOLERANCE,
+    "match_column_names": False,
+    "row_cap": None,
+    "timeout_ms": None,
+}
+
+@ensure_once
+def ensure_grading_policies_table(conn):
+    # major خالی یعنی همه رشته‌ها؛ سیاست رشته خاص بر آن مقدم است
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS grading_policies (
+            hw TEXT NOT NULL,
+            qnum INTEGER NOT NULL,
+            major TEXT NOT NULL DEFAULT '',
+            order_matters BOOLEAN,
+            tolerance REAL,
+            match_column_names BOOLEAN,
+            row_cap INTEGER,
+            timeout_ms INTEGER,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (hw, qnum, major)
+        )
+    """))
+
+def fetch_grading_policies(conn):
+    """(hw, qnum, major) -> سیاست کامل (ستون‌های NULL با مقدار پیش‌فرض پر می‌شوند)"""
+    ensure_grading_policies_table(conn)
+    rows = conn.execute(text(f"""
+        SELECT hw, qnum, major, {", ".join(DEFAULT_GRADING_POLICY)} FROM grading_policies
+    """)).mappings().all()
+    policies = {}
+    for row in rows:
+        policy = dict(DEFAULT_GRADING_POLICY)
+        policy.update({key: row[key] for key in DEFAULT_GRADING_POLICY if row[key] is not None})
+        policy["order_matters"] = bool(policy["order_matters"])
+        policy["match_column_names"] = bool(policy["match_column_names"])
+        policies[(row["hw"], row["qnum"], row["major"])] = policy
+    return policies
+
+grading_policies = TableCache(
+    "grading policies", fetch_grading_policies, GRADING_POLICY_CACHE_SECONDS, dict,
+)
+
+def grading_policy(policies, hw: str, qnum: int, major: str):
+    return policies.get((hw, qnum, major)) or policies.get((hw, qnum, "")) or DEFAULT_GRADING_POLICY
+
+# ==================== جدول‌های مرجع و اثر انگشت نتایج ====================
+
+def canonical_value(value) -> str:
+    """نمایش متنی یکسان برای مقادیری که در پایتون برابرند (مثلاً 1، 1.0 و Decimal('1.00'))"""
+    if value is None:
+        return "\x00"
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, (int, float, Decimal)):
+        if isinstance(value, float) and not math.isfinite(value):
+            return "n:" + repr(value)
+        number = Decimal(repr(value)) if isinstance(value, float) else Decimal(value)
+        if number.is_nan() or number.is_infinite():
+            return "n:" + str(number)
+        if number == 0:
+            return "n:0"
+        return "n:" + format(number.normalize(), "f")
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "b:" + bytes(value).hex()
+    if isinstance(value, (datetime, date, dt_time)):
+        # مثل متنی که snapshot تصحیح (SQLite) برای این نوع‌ها ذخیره می‌کند
+        return "s:" + str(value)
+    return "s:" + str(value)
+
+def row_digest(row) -> bytes:
+    return hashlib.sha1("\x1f".join(canonical_value(v) for v in row).encode("utf-8")).digest()
+
+class ResultFingerprint:
+    """اثر انگشت مستقل از ترتیب یک نتیجه: تعداد ردیف، تعداد ردیف یکتا، hash مجموعه و نوع ستون‌ها.
+
+    مثل مقایسه set در تصحیح، ردیف‌های تکراری فقط یک بار در hash حساب می‌شوند.
+    """
+
+    def __init__(self, column_count: int):
+        self.column_count = column_count
+        self.row_count = 0
+        self._digests = set()
+        self._types = [set() for _ in range(column_count)]
+
+    def add(self, row) -> bool:
+        """افزودن یک ردیف؛ True اگر ردیف تازه (غیرتکراری) بود"""
+        self.row_count += 1
+        for i, value in enumerate(row):
+            if value is not None:
+                self._types[i].add(type(value).__name__)
+        digest = row_digest(row)
+        if digest in self._digests:
+            return False
+        self._digests.add(digest)
+        return True
+
+    @property
+    def distinct_count(self) -> int:
+        return len(self._digests)
+
+    def content_hash(self) -> str:
+        return hashlib.sha256(b"".join(sorted(self._digests))).hexdigest()
+
+    def column_types(self):
+        return ["|".join(sorted(types)) or "null" for types in self._types]
+
+@ensure_once
+def ensure_reference_meta_table(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS reference_meta (
+            hw TEXT NOT NULL,
+            suffix TEXT NOT NULL,
+            qnum INTEGER NOT NULL,
+            table_name TEXT NOT NULL,
+            solution_sql TEXT NOT NULL,
+            row_count INTEGER NOT NULL,
+            distinct_count INTEGER NOT NULL,
+            column_count INTEGER NOT NULL,
+            column_names TEXT NOT NULL,
+            column_types TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (hw, suffix, qnum)
+        )
+    """))
+
+def materialize_references(hw: str, major: str, solution_sql: str):
+    """ساخت جدول‌های مرجع یک تمرین از روی SQL حل رسمی و ذخیره اثر انگشت هر کدام.
+
+    SQL با همان منطق parse_queries تقسیم می‌شود؛ همه جدول‌ها در یک تراکنش ساخته
+    می‌شوند تا خطا در یک سؤال جدول‌های قبلی را نیمه‌کاره باقی نگذارد.
+    """
+    suffix = reference_suffix(major)
+    queries = parse_queries(solution_sql)
+    summaries = []
+
+    with engine.begin() as conn:
+        ensure_reference_meta_table(conn)
+        conn.execute(
+            text("DELETE FROM reference_meta WHERE hw = :hw AND suffix = :suffix"),
+            {"hw": hw, "suffix": suffix},
+        )
+        for i, query in enumerate(queries):
+            qnum = i + 1
+            table_name = reference_table_name(hw, qnum, suffix)
+            conn.execute(text(f"DROP TABLE IF EXISTS {table_name}"))
+            conn.execute(text(f"CREATE TABLE {table_name} AS {query.rstrip(';')}"))
+            if GRADING_DB_ROLE and conn.dialect.name == "postgresql":
+                conn.execute(text(f'GRANT SELECT ON {table_name} TO "{GRADING_DB_ROLE}"'))
+
+            result = conn.execute(text(f"SELECT * FROM {table_name}"), execution_options={"stream_results": True})
+            column_names = list(result.keys())
+            fingerprint = ResultFingerprint(len(column_names))
+            for partition in result.partitions(1000):
+                for row in partition:
+                    fingerprint.add(row)
+
+            meta = {
+                "hw": hw,
+                "suffix": suffix,
+                "qnum": qnum,
+                "table_name": table_name,
+                "solution_sql": query,
+                "row_count": fingerprint.row_count,
+                "distinct_count": fingerprint.distinct_count,
+                "column_count": len(column_names),
+                "column_names": json.dumps(column_names, ensure_ascii=False),
+                "column_types": json.dumps(fingerprint.column_types()),
+                "content_hash": fingerprint.content_hash(),
+            }
+            conn.execute(
+                text("""
+                    INSERT INTO reference_meta
+                        (hw, suffix, qnum, table_name, solution_sql, row_count, distinct_count,
+                         column_count, column_names, column_types, content_hash)
+                    VALUES (:hw, :suffix, :qnum, :table_name, :solution_sql, :row_count, :distinct_count,
+                            :column_count, :column_names, :column_types, :content_hash)
+                """),
+                meta,
+            )
+            summaries.append(meta)
+    return summaries
+
+# ==================== مقایسه نتایج با تلرانس ====================
+
+NUMERIC_TYPES = (int, float, Decimal)
+# علاوه بر تلرانس مطلق، فقط برای خطای نمایش float در عددهای بزرگ
+FLOAT_RELATIVE_EPSILON = 1e-12
+
+def column_kind(*columns) -> str:
+    """نوع مقایسه ستون در هر دو نتیجه (بدون NULL): 'integer' اگر همه عدد صحیح باشند،
+    'numeric' اگر همه عدد و دست‌کم یکی اعشاری باشد، 'string' اگر همه رشته باشند و در
+    غیر این صورت 'text' (ترکیب نوع‌ها، تاریخ، bytes و ...)"""
+    types = set()
+    for column in columns:
+        types.update(map(type, column))
+    types.discard(type(None))
+    if all(issubclass(t, int) for t in types):
+        # شناسه، COUNT و SUM صحیح؛ اختلاف ۱ هم پاسخ غلط است
+        return "integer"
+    if all(issubclass(t, NUMERIC_TYPES) for t in types):
+        return "numeric"
+    if all(issubclass(t, str) for t in types):
+        return "string"
+    return "text"
+
+def normalize_text(value) -> str:
+    """مثل canonical_value ولی بدون فاصله انتهایی رشته‌ها (CHAR(n) در Postgres و ...)"""
+    if isinstance(value, str):
+        return "s:" + value.rstrip()
+    return canonical_value(value)
+
+def _python_rows(rows, kinds, order, ordered):
+    """ردیف‌های یکسان‌شده (بدون ordered یکتا و مرتب)؛ هر عدد به صورت (NULL است؟، مقدار float)"""
+    normalized = []
+    for row in rows:
+        key = []
+        for i in order:
+            value = row[i]
+            if kinds[i] != "numeric":
+                key.append(normalize_text(value))
+            else:
+                key.append((value is None, 0.0 if value is None else float(value)))
+        normalized.append(tuple(key))
+    return normalized if ordered else sorted(set(normalized))
+
+def _rows_close_python(student_rows, reference_rows, kinds, order, tolerance, ordered) -> bool:
+    student = _python_rows(student_rows, kinds, order, ordered)
+    reference = _python_rows(reference_rows, kinds, order, ordered)
+    if len(student) != len(reference):
+        return False
+    for student_row, reference_row in zip(student, reference):
+        for a, b in zip(student_row, reference_row):
+            if a == b:
+                continue
+            if isinstance(a, str) or a[0] or b[0]:
+                return False
+            if not math.isclose(a[1], b[1], rel_tol=FLOAT_RELATIVE_EPSILON, abs_tol=tolerance):
+                return False
+    return True
+
+def _text_codes(kind, student_column, reference_column):
+    """کد عددی یکسان برای مقدارهای برابر (متن یا عدد صحیح) در دو نتیجه؛ ترتیب کدها اهمیتی ندارد"""
+    # عدد صحیح خودش کلید می‌شود؛ float64 عددهای بزرگ‌تر از 2**53 را دقیق نگه نمی‌دارد
+    if kind == "string" and None not in student_column and None not in reference_column:
+        student_column = list(map(str.rstrip, student_column))
+        reference_column = list(map(str.rstrip, reference_column))
+    elif kind != "integer":
+        student_column = list(map(normalize_text, student_column))
+        reference_column = list(map(normalize_text, reference_column))
+    index = {value: code for code, value in enumerate(set(student_column).union(reference_column))}
+    return [
+        np.fromiter(map(index.__getitem__, column), dtype=np.float64, count=len(column))
+        for column in (student_column, reference_column)
+    ]
+
+def _column_blocks(student_columns, reference_columns, kinds, order):
+    """ماتریس float64 هر نتیجه: کد متن‌ها، پرچم NULL عددها و در آخر مقدار عددها"""
+    exact = ([], [])
+    values = ([], [])
+    for i in order:
+        if kinds[i] != "numeric":
+            for side, codes in enumerate(_text_codes(kinds[i], student_columns[i], reference_columns[i])):
+                exact[side].append(codes)
+            continue
+        for side, column in enumerate((student_columns[i], reference_columns[i])):
+            # None به NaN و Decimal با float() در خود numpy تبدیل می‌شوند
+            array = np.array(column, dtype=np.float64)
+            nulls = np.isnan(array)
+            array[nulls] = 0.0
+            exact[side].append(nulls.astype(np.float64))
+            values[side].append(array)
+    return [np.column_stack(exact[side] + values[side]) for side in (0, 1)], len(exact[0])
+
+def _unique_rows(matrix):
+    """مرتب‌سازی لغت‌نامه‌ای ردیف‌ها و حذف تکراری‌ها، مثل set"""
+    matrix = matrix[np.lexsort(matrix.T[::-1])]
+    keep = np.ones(len(matrix), dtype=bool)
+    keep[1:] = (matrix[1:] != matrix[:-1]).any(axis=1)
+    return matrix[keep]
+
+def _rows_close_numpy(student_columns, reference_columns, kinds, order, tolerance, ordered) -> bool:
+    (student, reference), exact_width = _column_blocks(student_columns, reference_columns, kinds, order)
+    if not ordered:
+        student = _unique_rows(student)
+        reference = _unique_rows(reference)
+    if student.shape != reference.shape:
+        return False
+    if not np.array_equal(student[:, :exact_width], reference[:, :exact_width]):
+        return False
+    return bool(np.isclose(student[:, exact_width:], reference[:, exact_width:],
+                           rtol=FLOAT_RELATIVE_EPSILON, atol=tolerance).all())
+
+def results_match(student_rows, reference_rows, tolerance=COMPARE_FLOAT_TOLERANCE, ordered=False) -> bool:
+    """مقایسه مجموعه‌ای (بدون ترتیب و تکرار) خروجی دانشجو با مرجع؛ با ordered ردیف به ردیف.
+
+    ستون عدد صحیح دقیق مقایسه می‌شود، ستون عددی با مقدار اعشاری به float تبدیل و با
+    تلرانس مطلق tolerance و بقیه ستون‌ها به متن یکسان‌شده. برای نتایج بزرگ و در صورت
+    نصب بودن numpy مقایسه ستونی و برداری انجام می‌شود، وگرنه با پایتون خالص و همان قواعد.
+    """
+    if not student_rows or not reference_rows:
+        return not student_rows and not reference_rows
+    width = len(reference_rows[0])
+    if len(student_rows[0]) != width:
+        return False
+    if ordered:
+        if len(student_rows) != len(reference_rows):
+            return False
+        if list(student_rows) == list(reference_rows):
+            return True
+    else:
+        try:
+            # حالت رایج: همان نوع‌ها و همان مقدارها؛ مقایسه set در C انجام می‌شود
+            if set(student_rows) == set(reference_rows):
+                return True
+        except TypeError:  # مقدار hash‌ناپذیر (آرایه و JSON در Postgres)
+            pass
+    student_columns = list(zip(*student_rows))
+    reference_columns = list(zip(*reference_rows))
+    kinds = [column_kind(student_columns[i], reference_columns[i]) for i in range(width)]
+    # ستون‌های متنی اول مرتب می‌شوند تا اختلاف کوچک اعشار ترتیب ردیف‌ها را عوض نکند
+    order = [i for i in range(width) if kinds[i] != "numeric"] + [i for i in range(width) if kinds[i] == "numeric"]
+    if np is not None and len(student_rows) + len(reference_rows) >= VECTORIZED_COMPARE_MIN_ROWS:
+        return _rows_close_numpy(student_columns, reference_columns, kinds, order, tolerance, ordered)
+    return _rows_close_python(student_rows, reference_rows, kinds, order, tolerance, ordered)
+
+# ==================== snapshot تصحیح (SQLite) ====================
+
+REFERENCE_TABLE_RE = re.compile(r"^hw\d+_q\d+_(cs|stat)_reference$")
+
+def snapshot_table_names(conn):
+    """جدول‌هایی که تصحیح به آنها نیاز دارد: جدول‌های مجاز، جدول‌های مرجع و reference_meta"""
+    existing = set(inspect(conn).get_table_names())
+    names = set()
+    if "allowed_tables" in existing:
+        names.update(row[0] for row in conn.execute(text("SELECT table_name FROM allowed_tables")))
+    names.update(name for name in existing if REFERENCE_TABLE_RE.match(name))
+    names.add("reference_meta")
+    return sorted(name for name in names if name in existing)
+
+def snapshot_affinity(column_type) -> str:
+    if isinstance(column_type, (sqltypes.Integer, sqltypes.Boolean)):
+        return "INTEGER"
+    if isinstance(column_type, sqltypes.Numeric):
+        return "NUMERIC"
+    if isinstance(column_type, sqltypes.String):
+        return "TEXT"
+    # نوع نامشخص (مثلاً ستون محاسبه‌شده در CREATE TABLE AS): مقدار همان‌طور که هست ذخیره شود
+    return ""
+
+def snapshot_value(value):
+    """تبدیل مقدار به نوعی که sqlite3 بدون adapter ذخیره می‌کند"""
+    if value is None or isinstance(value, (int, float, str, bytes)):
+        return value
+    if isinstance(value, (memoryview, bytearray)):
+        return bytes(value)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    # Decimal در ستون NUMERIC به عدد برمی‌گردد؛ تاریخ‌ها مثل canonical_value متن می‌شوند
+    return str(value)
+
+def copy_grading_snapshot(source_uri: str, target) -> int:
+    """کپی جدول‌های لازم برای تصحیح از دیتابیس منبع به اتصال sqlite3 مقصد"""
+    source = make_engine(source_uri, "GRADING_SNAPSHOT_SOURCE", pool_size=1, max_overflow=0)
+    started = time.perf_counter()
+    total_rows = 0
+    try:
+        with source.connect() as conn:
+            names = snapshot_table_names(conn)
+            inspector = inspect(conn)
+            quote = conn.dialect.identifier_preparer.quote
+            for name in names:
+                columns = inspector.get_columns(name)
+                column_sql = ", ".join(f'"{c["name"]}" {snapshot_affinity(c["type"])}' for c in columns)
+                target.execute(f'DROP TABLE IF EXISTS "{name}"')
+                target.execute(f'CREATE TABLE "{name}" ({column_sql})')
+                insert_sql = f'INSERT INTO "{name}" VALUES ({", ".join("?" for _ in columns)})'
+                result = conn.execute(text(f"SELECT * FROM {quote(name)}"), execution_options={"stream_results": True})
+                for partition in result.partitions(1000):
+                    target.executemany(insert_sql, [tuple(snapshot_value(v) for v in row) for row in partition])
+                    total_rows += len(partition)
+        target.commit()
+    finally:
+        source.dispose()
+    app.logger.info(f"Grading snapshot: {len(names)} tables, {total_rows} rows in {time.perf_counter() - started:.2f}s")
+    return len(names)
+
+def fetch_reference_version(conn) -> str:
+    """اثر انگشت کل reference_meta؛ با هر بارگذاری حل رسمی عوض می‌شود"""
+    if not inspect(conn).has_table("reference_meta"):
+        return ""
+    rows = conn.execute(text(
+        "SELECT hw, suffix, qnum, content_hash, created_at FROM reference_meta ORDER BY hw, suffix, qnum"
+    )).fetchall()
+    # created_at در snapshot به صورت متن ذخیره شده است
+    return hashlib.sha1(repr([tuple(map(str, row)) for row in rows]).encode("utf-8")).hexdigest()
+
+reference_version = TableCache(
+    "reference version", fetch_reference_version, GRADING_SNAPSHOT_REFRESH_SECONDS, lambda: None
+)
+
+def snapshot_reference_meta(conn, hw: str, suffix: str):
+    """اثر انگشت مرجع‌ها از خود snapshot؛ snapshotهای قدیمی reference_meta ندارند"""
+    if not inspect(conn).has_table("reference_meta"):
+        return {}
+    return select_reference_meta(conn, hw, suffix)
+
+# نسخه مرجع‌های snapshot فعلی این worker و شماره پایگاه حافظه‌ای بعدی
+_snapshot_version = None
+_snapshot_generation = itertools.count()
+_snapshot_refresh_lock = threading.Lock()
+
+def snapshot_bind(target: str, anchor, prefix: str, pool_size: int, max_overflow: int):
+    def connect():
+        # ارجاع به anchor در این closure، پایگاه حافظه‌ای را تا وقتی pool زنده است نگه می‌دارد
+        conn = sqlite3.connect(target, uri=True, check_same_thread=False)
+        if anchor is None:
+            conn.execute(f"PRAGMA mmap_size = {GRADING_SNAPSHOT_MMAP_BYTES}")
+        return conn
+
+    return create_engine(
+        "sqlite://", creator=connect, poolclass=QueuePool,
+        pool_size=int(os.environ.get(f"{prefix}_POOL_SIZE", pool_size)),
+        max_overflow=int(os.environ.get(f"{prefix}_MAX_OVERFLOW", max_overflow)),
+    )
+
+def make_snapshot_engine(uri: str, prefix: str, pool_size: int = 5, max_overflow: int = 10, **_):
+    """engine تصحیح روی snapshot SQLite؛ جایگزین make_engine برای grading_engine.
+
+    فایل GRADING_SNAPSHOT_PATH فقط اگر مرجع‌های آن با دیتابیس اصلی یکی باشد استفاده می‌شود؛
+    وگرنه (یا بدون فایل) کپی در حافظه همین worker ساخته می‌شود.
+    """
+    global _snapshot_version
+    expected = reference_version.get()
+    if GRADING_SNAPSHOT_PATH and os.path.exists(GRADING_SNAPSHOT_PATH):
+        bind = snapshot_bind(f"file:{GRADING_SNAPSHOT_PATH}?mode=ro", None, prefix, pool_size, max_overflow)
+        with bind.connect() as conn:
+            version = fetch_reference_version(conn)
+        if expected is None or version == expected:
+            _snapshot_version = version
+            return bind
+        bind.dispose()
+        app.logger.warning(f"Grading snapshot {GRADING_SNAPSHOT_PATH} has stale references; building in memory")
+    elif GRADING_SNAPSHOT_PATH:
+        app.logger.warning(f"Grading snapshot {GRADING_SNAPSHOT_PATH} not found; building in memory")
+
+    # حافظه مشترک بین اتصال‌های همین پردازه؛ هر بار ساخت دوباره نام جدا دارد تا اتصال‌های
+    # در حال استفاده نسخه قبلی را تا پایان کارشان ببینند
+    target = f"file:dbhw-grading-{os.getpid()}-{next(_snapshot_generation)}?mode=memory&cache=shared"
+    anchor = sqlite3.connect(target, uri=True, check_same_thread=False)
+    copy_grading_snapshot(uri, anchor)
+    bind = snapshot_bind(target, anchor, prefix, pool_size, max_overflow)
+    with bind.connect() as conn:
+        _snapshot_version = fetch_reference_version(conn)
+    return bind
+
+def refresh_grading_snapshot():
+    """ساخت دوباره snapshot این worker اگر جدول‌های مرجع پس از ساخت آن عوض شده باشند.
+
+    پیش از گرفتن نوبت تصحیح صدا زده می‌شود؛ نسخه مرجع‌ها حداکثر هر
+    GRADING_SNAPSHOT_REFRESH_SECONDS یک بار از دیتابیس اصلی خوانده می‌شود.
+    """
+    if GRADING_BACKEND != "snapshot" or not grading_engine.created:
+        return
+    version = reference_version.get()
+    if version is None or version == _snapshot_version:
+        return
+    with _snapshot_refresh_lock:
+        if version == _snapshot_version:
+            return
+        app.logger.info("Reference tables changed; rebuilding grading snapshot")
+        grading_engine.reset()
+        grading_engine.get()
+
+def write_grading_snapshot_file(source_uri: str) -> int:
+    """ساخت فایل snapshot در GRADING_SNAPSHOT_PATH با جایگزینی اتمی"""
+    partial = f"{GRADING_SNAPSHOT_PATH}.partial"
+    if os.path.exists(partial):
+        os.remove(partial)
+    target = sqlite3.connect(partial)
+    try:
+        count = copy_grading_snapshot(source_uri, target)
+    finally:
+        target.close()
+    # workerهایی که در حال باز کردن فایل‌اند نسخه نیمه‌کاره نمی‌بینند
+    os.replace(partial, GRADING_SNAPSHOT_PATH)
+    return count
+
+def grading_snapshot_changed():
+    """پس از ساخت جدول‌های مرجع: فایل snapshot (اگر تنظیم شده) دوباره نوشته و snapshot این
+    worker تازه می‌شود؛ workerهای دیگر حداکثر پس از GRADING_SNAPSHOT_REFRESH_SECONDS."""
+    if GRADING_BACKEND != "snapshot":
+        return
+    reference_version.invalidate()
+    try:
+        if GRADING_SNAPSHOT_PATH:
+            write_grading_snapshot_file(GRADING_DB_URI)
+        refresh_grading_snapshot()
+    except Exception as e:
+        app.logger.error(f"Error refreshing grading snapshot: {e}")
+
+if GRADING_BACKEND == "snapshot":
+    grading_engine.factory = make_snapshot_engine
+
+@app.cli.command("build-grading-snapshot")
+def build_grading_snapshot_command():
+    """ساخت فایل snapshot تصحیح در GRADING_SNAPSHOT_PATH"""
+    if not GRADING_SNAPSHOT_PATH:
+        raise SystemExit("GRADING_SNAPSHOT_PATH is not set")
+    count = write_grading_snapshot_file(GRADING_DB_URI)
+    print(f"Wrote {count} tables to {GRADING_SNAPSHOT_PATH}")
+
+# ==================== متریک‌ها ====================
+# زیر gunicorn با چند worker باید PROMETHEUS_MULTIPROC_DIR تنظیم شده باشد (gunicorn.conf.py)
+
+REQUEST_LATENCY = Histogram(
+    "dbhw_request_duration_seconds", "Request latency per Flask endpoint",
+    ["endpoint", "method", "status"],
+)
+GRADING_QUESTION_SECONDS = Histogram(
+    "dbhw_grading_question_duration_seconds", "Time to grade a single question",
+    ["hw", "major"],
+)
+GRADING_SUBMISSION_SECONDS = Histogram(
+    "dbhw_grading_submission_duration_seconds", "Time to grade a whole homework submission",
+    ["hw", "major"], buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+GRADED_QUESTIONS = Counter(
+    "dbhw_graded_questions_total", "Graded questions by outcome (correct, wrong, error, rejected)",
+    ["hw", "outcome"],
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "dbhw_db_pool_checked_out", "Connections currently checked out of the SQLAlchemy pool",
+    ["engine"], multiprocess_mode="livesum",
+)
+DB_POOL_OVERFLOW = Gauge(
+    "dbhw_db_pool_overflow", "Overflow connections currently open beyond pool_size",
+    ["engine"], multiprocess_mode="livesum",
+)
+SESSION_COOKIE_BYTES = Histogram(
+    "dbhw_session_cookie_bytes", "Size of the session cookie sent with each request",
+    buckets=(128, 256, 512, 1024, 2048, 3072, 4096, 8192),
+)
+
+def update_pool_gauges():
+    for name, bind in (("app", engine), ("grading", grading_engine)):
+        if not bind.created:
+            continue
+        pool = bind.pool
+        # فقط QueuePool شمارنده‌های checkedout/overflow دارد
+        if hasattr(pool, "checkedout"):
+            DB_POOL_CHECKED_OUT.labels(name).set(pool.checkedout())
+            DB_POOL_OVERFLOW.labels(name).set(max(pool.overflow(), 0))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+    # کوکی session با هر درخواست ارسال می‌شود؛ اندازه آن هزینه مستقیم هر درخواست است
+    session_cookie = request.cookies.get(app.config["SESSION_COOKIE_NAME"])
+    if session_cookie:
+        SESSION_COOKIE_BYTES.observe(len(session_cookie))
+
+@app.after_request
+def observe_request(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        REQUEST_LATENCY.labels(
+            request.endpoint or "unknown", request.method, str(response.status_code)
+        ).observe(time.perf_counter() - started)
+
+    update_pool_gauges()
+    return response
+
+# ==================== پایش کوئری‌های دیتابیس ====================
+
+DB_STATEMENTS_PER_REQUEST = Histogram(
+    "dbhw_db_statements_per_request", "Database statements executed per request",
+    ["endpoint"], buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50),
+)
+
+def instrument_engine(bind, name: str):
+    """ثبت زمان هر دستور SQL، لاگ کوئری‌های کند و جمع آمار در سطح درخواست"""
+
+    @event.listens_for(bind, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(bind, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.perf_counter() - conn.info["query_start_time"].pop()) * 1000
+        route = None
+        if has_request_context():
+            route = request.endpoint
+            g.db_statements = g.get("db_statements", 0) + 1
+            g.db_time_ms = g.get("db_time_ms", 0.0) + elapsed_ms
+        if elapsed_ms >= SLOW_QUERY_MS:
+            app.logger.warning(
+                f"Slow query ({elapsed_ms:.1f} ms) on {name} in route {route or '-'}: "
+                f"{' '.join(statement.split())[:500]}"
+            )
+
+    @event.listens_for(bind, "handle_error")
+    def handle_error(exception_context):
+        # after_cursor_execute برای دستورهای خطادار صدا زده نمی‌شود
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_start_time"):
+            conn.info["query_start_time"].pop()
+
+
+@app.after_request
+def report_query_budget(response):
+    statements = g.get("db_statements", 0)
+    db_time_ms = g.get("db_time_ms", 0.0)
+    endpoint = request.endpoint or "unknown"
+    DB_STATEMENTS_PER_REQUEST.labels(endpoint).observe(statements)
+
+    if statements > QUERY_BUDGET:
+        app.logger.warning(
+            f"Route {endpoint} ran {statements} statements ({db_time_ms:.1f} ms), budget is {QUERY_BUDGET}"
+        )
+
+    if APP_ENV != "production":
+        response.headers["X-DB-Queries"] = str(statements)
+        response.headers["X-DB-Time-ms"] = f"{db_time_ms:.2f}"
+        response.headers["Server-Timing"] = f'db;dur={db_time_ms:.2f};desc="{statements} queries"'
+    return response
+
+# ==================== کنترل پذیرش و کاهش بار ====================
+
+ADMISSION_IN_FLIGHT = Gauge(
+    "dbhw_admission_in_flight", "Requests currently holding an admission slot",
+    ["controller"], multiprocess_mode="livesum",
+)
+ADMISSION_QUEUED = Gauge(
+    "dbhw_admission_queued", "Requests waiting for an admission slot",
+    ["controller"], multiprocess_mode="livesum",
+)
+ADMISSION_REJECTED = Counter(
+    "dbhw_admission_rejected_total", "Requests turned away because the controller was full",
+    ["controller", "reason"],
+)
+
+class AdmissionRejected(Exception):
+    """ظرفیت پر است؛ position جایگاه در صف و retry_after زمان پیشنهادی تلاش دوباره است.
+
+    reason برابر 'owner_limit' یعنی همین دانشجو از قبل به سقف کارهای همزمان خود رسیده است.
+    """
+
+    def __init__(self, position: int, retry_after: int, reason: str = "busy"):
+        super().__init__(f"{reason}, position {position}, retry after {retry_after}s")
+        self.position = position
+        self.retry_after = retry_after
+        self.reason = reason
+
+    @property
+    def message(self) -> str:
+        if self.reason == "owner_limit":
+            return f"ارسال قبلی شما هنوز در حال تصحیح است. لطفاً {self.retry_after} ثانیه دیگر دوباره تلاش کنید."
+        return f"سرور مشغول است (نفر {self.position} در صف). لطفاً {self.retry_after} ثانیه دیگر دوباره تلاش کنید."
+
+    @property
+    def status(self) -> int:
+        return 429 if self.reason == "owner_limit" else 503
+
+class AdmissionController:
+    """محدودکننده همزمانی کارهای سنگین دیتابیس در هر worker و بین workerها.
+
+    در هر worker حداکثر worker_slots کار همزمان اجرا می‌شود و با قفل فایل (flock)
+    در ADMISSION_LOCK_DIR بین همه workerهای یک سرور هم حداکثر global_slots کار.
+    بقیه درخواست‌ها به ترتیب در صف می‌مانند؛ اگر صف پر باشد یا انتظار بیش از
+    max_wait طول بکشد، AdmissionRejected با جایگاه صف بالا می‌آید.
+
+    هر کار می‌تواند صاحب (owner، شماره دانشجویی) داشته باشد. هر صاحب حداکثر
+    max_per_owner کار در صف یا در حال اجرا دارد (با flock بین workerها هم) و در صف
+    به نوبت بین صاحب‌ها چرخیده می‌شود (start-time fair queuing): کار k-ام یک دانشجو
+    بعد از کار اول همه دانشجوهای دیگری که در صف منتظرند اجرا می‌شود.
+    """
+
+    def __init__(self, name, worker_slots, global_slots, max_queue, max_wait, max_per_owner=0,
+                 lock_dir=ADMISSION_LOCK_DIR):
+        self.name = name
+        self.worker_slots = max(worker_slots, 1)
+        self.global_slots = global_slots if fcntl is not None else 0
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_per_owner = max_per_owner
+        self.lock_dir = lock_dir
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = []
+        self._seq = itertools.count()
+        # میانگین نمایی مدت هر کار برای تخمین زمان تلاش دوباره
+        self._avg_seconds = 1.0
+        # نوبت مجازی: برچسب آخرین کار خارج‌شده از صف و برچسب آخرین کار هر صاحب
+        self._virtual_time = 0
+        self._owner_tags = {}
+        self._owner_jobs = {}
+
+    def _queue_key(self, seq, priority, owner=None):
+        if owner is None:
+            tag = self._virtual_time
+        else:
+            tag = max(self._virtual_time, self._owner_tags.get(owner, 0)) + 1
+            self._owner_tags[owner] = tag
+        return (priority, tag, seq)
+
+    def _try_lock(self, prefix: str, count: int):
+        """گرفتن یکی از count قفل فایل با این پیشوند؛ None اگر همه در دست پردازه‌های دیگر باشند"""
+        os.makedirs(self.lock_dir, exist_ok=True)
+        for i in range(count):
+            fd = os.open(os.path.join(self.lock_dir, f"{self.name}-{prefix}{i}.lock"), os.O_CREAT | os.O_RDWR, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except OSError:
+                os.close(fd)
+        return None
+
+    def _try_global_slot(self):
+        """گرفتن یکی از global_slots قفل فایل؛ None اگر همه در دست workerهای دیگر باشند"""
+        if self.global_slots <= 0:
+            return -1
+        return self._try_lock("", self.global_slots)
+
+    def _retry_after(self, position: int) -> int:
+        return max(1, math.ceil(self._avg_seconds * position / self.worker_slots))
+
+    def _position(self, entry) -> int:
+        return sum(1 for other in self._waiting if other < entry) + 1
+
+    def _reject(self, position: int, reason: str):
+        ADMISSION_REJECTED.labels(self.name, reason).inc()
+        raise AdmissionRejected(position, self._retry_after(position), reason)
+
+    def _claim_owner(self, owner):
+        """ثبت یک کار برای owner؛ اگر به سقف رسیده باشد owner_limit. برگرداندن fd قفل صاحب یا -1"""
+        if owner is None:
+            return -1
+        with self._cond:
+            jobs = self._owner_jobs.get(owner, 0)
+            if self.max_per_owner > 0 and jobs >= self.max_per_owner:
+                self._reject(jobs, "owner_limit")
+            self._owner_jobs[owner] = jobs + 1
+        if self.max_per_owner <= 0 or self.global_slots <= 0:
+            return -1
+        # درخواست‌های یک دانشجو ممکن است به workerهای مختلف برسند
+        digest = hashlib.sha1(str(owner).encode("utf-8")).hexdigest()[:16]
+        fd = self._try_lock(f"owner-{digest}-", self.max_per_owner)
+        if fd is None:
+            self._release_owner(owner, -1)
+            with self._cond:
+                self._reject(self.max_per_owner, "owner_limit")
+        return fd
+
+    def _release_owner(self, owner, owner_fd):
+        if owner_fd >= 0:
+            os.close(owner_fd)
+        if owner is None:
+            return
+        with self._cond:
+            jobs = self._owner_jobs.get(owner, 0) - 1
+            if jobs > 0:
+                self._owner_jobs[owner] = jobs
+            else:
+                # دانشجوی بیکار با نوبت تازه برمی‌گردد و دیکشنری‌ها بزرگ نمی‌شوند
+                self._owner_jobs.pop(owner, None)
+                self._owner_tags.pop(owner, None)
+
+    def acquire(self, priority=math.inf, owner=None):
+        """priority کوچک‌تر زودتر از صف خارج می‌شود؛ در priority برابر به نوبت بین صاحب‌ها و بعد به ترتیب ورود"""
+        deadline = time.monotonic() + self.max_wait
+        owner_fd = self._claim_owner(owner)
+        try:
+            with self._cond:
+                if len(self._waiting) >= self.max_queue:
+                    self._reject(len(self._waiting) + 1, "queue_full")
+                entry = self._queue_key(next(self._seq), priority, owner)
+                heapq.heappush(self._waiting, entry)
+                ADMISSION_QUEUED.labels(self.name).inc()
+                try:
+                    while True:
+                        if self._active < self.worker_slots and self._waiting[0] == entry:
+                            fd = self._try_global_slot()
+                            if fd is not None:
+                                heapq.heappop(self._waiting)
+                                self._virtual_time = max(self._virtual_time, entry[1])
+                                self._active += 1
+                                ADMISSION_IN_FLIGHT.labels(self.name).inc()
+                                return fd, time.monotonic(), owner, owner_fd
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            position = self._position(entry)
+                            self._waiting.remove(entry)
+                            heapq.heapify(self._waiting)
+                            self._cond.notify_all()
+                            self._reject(position, "timeout")
+                        # slot سراسری ممکن است در worker دیگری آزاد شود؛ باید دوباره بررسی کرد
+                        self._cond.wait(min(remaining, 0.05))
+                finally:
+                    ADMISSION_QUEUED.labels(self.name).dec()
+        except BaseException:
+            self._release_owner(owner, owner_fd)
+            raise
+
+    def release(self, ticket):
+        fd, started, owner, owner_fd = ticket
+        if fd >= 0:
+            os.close(fd)  # بستن فایل قفل flock را آزاد می‌کند
+        with self._cond:
+            self._active -= 1
+            self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * (time.monotonic() - started)
+            ADMISSION_IN_FLIGHT.labels(self.name).dec()
+            self._cond.notify_all()
+        self._release_owner(owner, owner_fd)
+
+    @contextmanager
+    def slot(self, priority=math.inf, owner=None):
+        ticket = self.acquire(priority, owner)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+grading_admission = AdmissionController(
+    "grading", GRADING_WORKER_SLOTS, GRADING_GLOBAL_SLOTS, GRADING_MAX_QUEUE, GRADING_MAX_WAIT_SECONDS,
+    max_per_owner=GRADING_MAX_PER_STUDENT,
+)
+
+def busy_response(busy: AdmissionRejected):
+    response = Response(
+        render_template("busy.html", position=busy.position, retry_after=busy.retry_after, reason=busy.reason),
+        status=busy.status,
+    )
+    response.headers["Retry-After"] = str(busy.retry_after)
+    return response
+
+# ==================== محدودیت نرخ درخواست ====================
+
+RATE_LIMITED = Counter(
+    "dbhw_rate_limited_total", "Requests rejected by the token-bucket rate limiter",
+    ["route", "scope"],
+)
+
+def parse_rate(spec: str):
+    """'20/60' -> (ظرفیت 20، 20/60 توکن در ثانیه)؛ None اگر غیرفعال باشد"""
+    if not spec or spec.strip() == "0":
+        return None
+    count, _, seconds = spec.partition("/")
+    capacity = float(count)
+    return capacity, capacity / float(seconds or 1)
+
+class TokenBucketStore:
+    """bucketهای محدودیت نرخ در یک فایل SQLite مشترک بین workerها.
+
+    هر درخواست همه bucketهای مربوط را در یک تراکنش IMMEDIATE بررسی می‌کند و فقط وقتی
+    همه توکن داشته باشند از همه کم می‌کند. اگر فایل در دسترس نباشد درخواست رد نمی‌شود.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._takes = itertools.count()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = OFF")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, limits):
+        """limits: [(key, capacity, refill_per_second)]؛ برگرداندن (مجاز؟، ثانیه تا توکن بعدی، key محدودکننده)"""
+        try:
+            conn = self._connection()
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                updates = []
+                for key, capacity, rate in limits:
+                    row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                    tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+                    if tokens < 1:
+                        conn.execute("ROLLBACK")
+                        return False, math.ceil((1 - tokens) / rate), key
+                    updates.append((key, tokens - 1, now))
+                conn.executemany(
+                    "INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                    updates,
+                )
+                if next(self._takes) % 1000 == 0:
+                    # bucketهایی که یک ساعت استفاده نشده‌اند دوباره پر شده‌اند و لازم نیستند
+                    conn.execute("DELETE FROM buckets WHERE updated < ?", (now - 3600,))
+                conn.execute("COMMIT")
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            app.logger.error(f"Rate limiter store unavailable, allowing request: {e}")
+        return True, 0, None
+
+rate_limit_store = TokenBucketStore(RATE_LIMIT_DB)
+
+def check_rate_limit(route: str, student_id, ip):
+    """برداشتن یک توکن از bucketهای دانشجو و IP؛ برگرداندن None یا ثانیه‌های انتظار"""
+    limits = []
+    for scope, identity in (("student", student_id), ("ip", ip)):
+        rate = parse_rate(RATE_LIMITS.get((route, scope), ""))
+        if rate and identity:
+            limits.append((f"{route}:{scope}:{identity}", *rate))
+    if not limits:
+        return None
+    allowed, retry_after, key = rate_limit_store.take(limits)
+    if allowed:
+        return None
+    RATE_LIMITED.labels(route, key.split(":")[1]).inc()
+    return retry_after
+
+def rate_limited(route: str):
+    """محدودیت نرخ درخواست‌های POST یک روت به ازای دانشجو و IP"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != "POST":
+                return view(*args, **kwargs)
+            retry_after = check_rate_limit(route, session.get("student_id"), request.remote_addr)
+            if retry_after is None:
+                return view(*args, **kwargs)
+            response = Response(render_template("rate_limited.html", retry_after=retry_after), status=429)
+            response.headers["Retry-After"] = str(retry_after)
+            return response
+        return wrapper
+    return decorator
+
+@app.route("/metrics")
+def metrics():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return Response("forbidden", status=403)
+
+    update_pool_gauges()
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        # جمع‌کردن مقادیر همه workerها از فایل‌های پوشه مشترک
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+# ==================== کش HTTP و فشرده‌سازی ====================
+
+# پاسخ‌های کوچک‌تر از این اندازه فشرده نمی‌شوند؛ هزینه gzip از صرفه‌جویی بیشتر است
+GZIP_MIN_BYTES = int(os.environ.get("GZIP_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", "6"))
+COMPRESSIBLE_MIMETYPES = {
+    "text/html", "text/css", "text/csv", "text/plain", "application/json", "application/javascript",
+}
+
+def compute_build_tag() -> str:
+    """شناسه نسخه از روی زمان تغییر کد و قالب‌ها؛ با هر deploy عوض می‌شود و بین workerها یکسان است"""
+    paths = [__file__]
+    templates_dir = os.path.join(app.root_path, app.template_folder)
+    paths += [os.path.join(templates_dir, name) for name in sorted(os.listdir(templates_dir))]
+    stamp = "|".join(f"{path}:{os.stat(path).st_mtime_ns}" for path in paths)
+    return hashlib.sha1(stamp.encode()).hexdigest()[:12]
+
+BUILD_TAG = compute_build_tag()
+
+_static_versions = {}
+
+def static_version(filename: str):
+    """hash محتوای فایل static؛ با تغییر mtime دوباره حساب می‌شود"""
+    path = os.path.join(app.static_folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = _static_versions.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, "rb") as f:
+        version = hashlib.sha1(f.read()).hexdigest()[:10]
+    _static_versions[filename] = (mtime, version)
+    return version
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    # url_for('static', ...) آدرس نسخه‌دار می‌سازد؛ با تغییر فایل آدرس هم عوض می‌شود
+    if endpoint == "static" and "filename" in values and "v" not in values:
+        version = static_version(values["filename"])
+        if version:
+            values["v"] = version
+
+def identity_etag(*parts) -> str:
+    return hashlib.sha1("\x1f".join([BUILD_TAG, *map(str, parts)]).encode("utf-8")).hexdigest()
+
+def identity_cached(render, *parts):
+    """GET شرطی برای صفحاتی که فقط به هویت کاربر بستگی دارند.
+
+    اگر ETag مرورگر با هویت و نسخه فعلی یکی باشد 304 برمی‌گردد و قالب رندر نمی‌شود.
+    وقتی پیام flash در صف است صفحه رندر و کش نمی‌شود، چون پیام بخشی از خروجی است.
+    """
+    if "_flashes" in session:
+        return render()
+    etag = identity_etag(request.endpoint, *parts)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Cookie")
+    return response
+
+@app.after_request
+def cache_and_compress(response):
+    if request.endpoint == "static" and request.args.get("v"):
+        # آدرس نسخه‌دار هرگز محتوای دیگری نمی‌گیرد
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+
+    if (
+        response.status_code != 200
+        or response.direct_passthrough
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+        or "gzip" not in request.headers.get("Accept-Encoding", "")
+    ):
+        return response
+
+    body = response.get_data()
+    if len(body) < GZIP_MIN_BYTES:
+        return response
+    response.set_data(gzip.compress(body, compresslevel=GZIP_LEVEL))
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # بدنه فشرده بایت‌به‌بایت با نسخه اصلی برابر نیست
+        response.set_etag(etag, weak=True)
+    return response
+
+# ==================== راه‌اندازی ====================
+
+STARTUP_SECONDS = Gauge(
+    "dbhw_startup_seconds", "Time spent importing the app module and running create_app()",
+    ["phase"], multiprocess_mode="max",
+)
+
+_app_ready = False
+
+def create_app():
+    """آماده‌سازی اپلیکیشن و برگرداندن آن؛ نقطه ورود gunicorn: app:create_app()
+
+    روت‌ها روی app سطح ماژول ثبت شده‌اند و این تابع فقط یک بار کار راه‌اندازی
+    (بررسی اتصال دیتابیس و اندازه‌گیری زمان شروع) را انجام می‌دهد.
+    """
+    global _app_ready
+    if _app_ready:
+        return app
+
+    started = time.perf_counter()
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    except Exception as e:
+        app.logger.error(f"Database check failed at startup: {e}")
+
+    finished = time.perf_counter()
+    app.config["STARTUP_SECONDS"] = {
+        "import": round(started - _IMPORT_STARTED, 4),
+        "create_app": round(finished - started, 4),
+    }
+    for phase, seconds in app.config["STARTUP_SECONDS"].items():
+        STARTUP_SECONDS.labels(phase).set(seconds)
+    app.logger.info(f"App ready in {finished - _IMPORT_STARTED:.3f}s {app.config['STARTUP_SECONDS']}")
+
+    _app_ready = True
+    return app
+
 # ==================== روت‌ها ====================
 
 @app.route("/", methods=["GET", "POST"])
@@ -128,12 +2637,14 @@ def login():
 
         name, major = authenticate(student_id, password)
         if not name:
+            audit("login_failed", actor=student_id)
             flash("شماره دانشجویی یا رمز عبور اشتباه است.", "danger")
             return redirect(url_for("login"))
 
         session["student_id"] = student_id
         session["name"] = name
         session["major"] = major
+        audit("login")
         return redirect(url_for("dashboard"))
     
     return render_template("login.html")
@@ -143,14 +2654,18 @@ def dashboard():
     if "student_id" not in session:
         flash("ابتدا وارد شوید.", "warning")
         return redirect(url_for("login"))
-    return render_template(
-        "dashboard.html",
-        name=session["name"],
-        student_id=session["student_id"],
-        major=session["major"]
+    return identity_cached(
+        lambda: render_template(
+            "dashboard.html",
+            name=session["name"],
+            student_id=session["student_id"],
+            major=session["major"]
+        ),
+        session["student_id"], session["name"], session["major"],
     )
 
 @app.route("/submit", methods=["GET", "POST"])
+@rate_limited("submit")
 def submit():
     if "student_id" not in session:
         flash("لطفاً ابتدا وارد شوید.", "warning")
@@ -161,18 +2676,27 @@ def submit():
     major = session["major"]
 
     if request.method == "GET":
-        return render_template("submit.html", majors=MAJORS, hw_numbers=HW_NUMBERS, name=name, student_id=student_id, major=major)
+        homeworks = [(hw, format_datetime_fa(closes_at) if closes_at else None) for hw, closes_at in open_homeworks()]
+        return identity_cached(
+            lambda: render_template("submit.html", majors=MAJORS, homeworks=homeworks, name=name, student_id=student_id, major=major),
+            student_id, name, major, homeworks,
+        )
 
     hw = request.form.get("hw")
     sql_text = request.form.get("sql_text", "")
     file = request.files.get("sql_file")
 
-    if hw not in HW_NUMBERS:
+    # زمان از کش خوانده می‌شود؛ ارسال خارج از بازه قبل از هر کوئری رد می‌شود
+    status = homework_status(hw)
+    if status is None:
         flash("تمرین معتبر انتخاب کنید.", "danger")
         return redirect(url_for("submit"))
+    if status != "open":
+        flash(HOMEWORK_CLOSED_MESSAGES[status].format(hw=hw), "warning")
+        return redirect(url_for("submit"))
 
     submission_count = get_submission_count(student_id, hw)
-    if submission_count >= 10:
+    if submission_count >= MAX_SUBMISSIONS:
         flash(f"شما قبلاً ۱۰ بار تمرین {hw} را ارسال کرده‌اید.", "warning")
         return redirect(url_for("submit"))
 
@@ -188,50 +2712,34 @@ def submit():
         return redirect(url_for("submit"))
 
     queries = parse_queries(sql_text)
-    correct_count = 0
-    incorrect_questions = []
 
-    with engine.begin() as conn:
-        conn.execute(text(
-            """
-            CREATE TABLE IF NOT EXISTS student_results (
-                id SERIAL PRIMARY KEY,
-                student_id TEXT NOT NULL,
-                name TEXT NOT NULL,
-                major TEXT NOT NULL,
-                hw TEXT NOT NULL,
-                correct_count INTEGER NOT NULL,
-                submission_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-            """
-        ))
-
-        suffix = "stat" if major == "آمار" else "cs"
-
-        for i, student_query in enumerate(queries):
-            qnum = i + 1
-            reference_table = f"hw{hw}_q{qnum}_{suffix}_reference"
-            try:
-                student_rows = conn.execute(text(student_query)).fetchall()
-                reference_rows = conn.execute(text(f"SELECT * FROM {reference_table}")).fetchall()
-                if set(student_rows) == set(reference_rows):
-                    correct_count += 1
-                else:
-                    incorrect_questions.append(qnum)
-            except Exception as e:
-                app.logger.error(f"Error executing q{qnum}: {e}")
-                incorrect_questions.append(qnum)
+    # اجرای کوئری‌های دانشجو روی engine تصحیح، در تراکنش فقط‌خواندنی با محدودیت زمان
+    rejected = []
+    # نتیجه هر سؤال فقط برای امتیاز کارایی لازم است و فقط در آن حالت ذخیره می‌شود
+    details = [] if EFFICIENCY_SCORING else None
+    # هر چه از دیتابیس اصلی لازم است پیش از گرفتن نوبت تصحیح خوانده می‌شود
+    policies = grading_policies.get()
+    refresh_grading_snapshot()
+    try:
+        with grading_admission.slot(homework_priority(hw), owner=student_id):
+            with guarded_connection(grading_engine, read_only=True,
+                                    timeout_ms=GRADING_STATEMENT_TIMEOUT_MS, commit=False) as grading_conn:
+                correct_count, incorrect_questions = grade_submission(
+                    grading_conn, hw, major, queries, rejected=rejected, details=details, policies=policies
+                )
+    except AdmissionRejected as busy:
+        return busy_response(busy)
+    for qnum, reason in rejected:
+        flash(f"سؤال {qnum} اجرا نشد: {reason}", "warning")
 
-        conn.execute(
-            text(
-                "INSERT INTO student_results (student_id, name, major, hw, correct_count) "
-                "VALUES (:student_id, :name, :major, :hw, :correct_count)"
-            ),
-            {"student_id": student_id, "name": name, "major": major, "hw": hw, "correct_count": correct_count},
-        )
+    with engine.begin() as conn:
+        record_submission(conn, student_id, name, major, hw, correct_count, details)
+    invalidate_student_history(student_id)
+    audit("submission", target=f"hw{hw}", correct=correct_count, total=len(queries),
+          incorrect=incorrect_questions, rejected=[qnum for qnum, _ in rejected])
 
     new_submission_count = submission_count + 1
-    remaining = 10 - new_submission_count
+    remaining = MAX_SUBMISSIONS - new_submission_count
     
     # ذخیره زمان به صورت رشته برای جلوگیری از مشکلات serialization
     current_time = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
@@ -247,9 +2755,31 @@ def submit():
         "done": new_submission_count,
         "remaining": remaining,
         "time": current_time,  # ذخیره به صورت رشته
+        "efficiency": efficiency_summary(details),
     }
     return redirect(url_for("result"))
 
+@app.route("/history")
+def history():
+    if "student_id" not in session:
+        flash("ابتدا وارد شوید.", "warning")
+        return redirect(url_for("login"))
+
+    try:
+        summary = load_student_history(session["student_id"])
+    except Exception as e:
+        app.logger.error(f"Error loading history for {session['student_id']}: {e}")
+        flash("خطا در بارگذاری تاریخچه ارسال‌ها.", "danger")
+        summary = []
+
+    return render_template(
+        "history.html",
+        summary=summary,
+        name=session["name"],
+        student_id=session["student_id"],
+        max_submissions=MAX_SUBMISSIONS,
+    )
+
 @app.route("/register_email", methods=["GET", "POST"])
 def register_email():
     student_id = session.get("student_id")
@@ -318,7 +2848,27 @@ def admin_stats():
     except Exception as e:
         flash(f"خطا در بارگذاری آمار: {e}", "danger")
         rows = []
-    return render_template("admin_stats.html", rows=rows)
+
+    efficiency_rows = []
+    if EFFICIENCY_SCORING:
+        try:
+            with engine.begin() as conn:
+                ensure_question_results_table(conn)
+                efficiency_rows = conn.execute(text(
+                    """
+                    SELECT sr.major, qr.hw, qr.qnum, COUNT(*) AS measured,
+                           AVG(qr.efficiency) AS avg_efficiency,
+                           AVG(qr.student_ms) AS avg_student_ms, AVG(qr.reference_ms) AS avg_reference_ms
+                    FROM question_results qr
+                    JOIN student_results sr ON sr.id = qr.result_id
+                    WHERE qr.efficiency IS NOT NULL
+                    GROUP BY sr.major, qr.hw, qr.qnum
+                    ORDER BY sr.major, qr.hw, qr.qnum
+                    """
+                )).mappings().all()
+        except Exception as e:
+            flash(f"خطا در بارگذاری آمار کارایی: {e}", "danger")
+    return render_template("admin_stats.html", rows=rows, efficiency_rows=efficiency_rows)
 
 @app.route("/logout")
 def logout():
@@ -363,6 +2913,7 @@ def change_password():
                     text("UPDATE stuid SET pass=:new_pass WHERE student_id=:sid"),
                     {"new_pass": new_pass, "sid": student_id}
                 )
+            audit("password_change", target=student_id)
             flash("رمز عبور با موفقیت تغییر کرد.", "success")
             return redirect(url_for("dashboard"))
         except Exception as e:
@@ -383,9 +2934,12 @@ def admin_login():
         
         if username == ADMIN_USERNAME and password == ADMIN_PASSWORD:
             session["admin_logged_in"] = True
+            session["admin_username"] = username
+            audit("admin_login")
             flash("ورود ادمین موفقیت‌آمیز بود.", "success")
             return redirect(url_for("admin_dashboard"))
         else:
+            audit("admin_login_failed", actor=username)
             flash("نام کاربری یا رمز عبور اشتباه است.", "danger")
     
     return render_template("admin_login.html")
@@ -406,31 +2960,107 @@ def admin_query():
     
     output = None
     query_text = ""
+    mode = "run"
+    read_only = True
+    timeout_ms = ADMIN_QUERY_TIMEOUT_MS
     
     if request.method == "POST":
         query_text = request.form.get("query", "").strip()
+        mode = request.form.get("mode", "run")
+        read_only = request.form.get("read_only") == "1"
+        timeout_ms = request.form.get("timeout_ms", type=int, default=ADMIN_QUERY_TIMEOUT_MS)
+        offset = max(request.form.get("offset", type=int, default=0), 0)
         
         if not query_text:
             flash("لطفاً یک کوئری وارد کنید.", "danger")
             return redirect(url_for("admin_query"))
         
-        try:
-            with engine.begin() as conn:
-                result = conn.execute(text(query_text))
+        if mode not in ("run", "explain", "explain_analyze"):
+            mode = "run"
+        
+        # صفحه بعد یعنی اجرای دوباره کل دستور؛ برای دستور نوشتنی (مثلاً UPDATE ... RETURNING) یعنی تکرار تغییر
+        if offset and not is_select_statement(query_text):
+            flash("ردیف‌های بعدی فقط برای دستورهای SELECT قابل دریافت است.", "danger")
+            return redirect(url_for("admin_query"))
+        
+        if request.form.get("action") == "save":
+            save_name = request.form.get("save_name", "").strip()
+            if not save_name:
+                flash("لطفاً برای ذخیره کوئری یک نام وارد کنید.", "danger")
+            else:
+                try:
+                    with engine.begin() as conn:
+                        ensure_query_log_tables(conn)
+                        conn.execute(
+                            text("""
+                                INSERT INTO admin_saved_queries (name, query_text)
+                                VALUES (:name, :query_text)
+                                ON CONFLICT (name) DO UPDATE SET query_text = excluded.query_text
+                            """),
+                            {"name": save_name, "query_text": query_text}
+                        )
+                    flash(f"کوئری با نام '{save_name}' ذخیره شد.", "success")
+                except Exception as e:
+                    flash(f"خطا در ذخیره کوئری: {str(e)}", "danger")
+        else:
+            started = time.perf_counter()
+            try:
+                output = run_console_query(query_text, mode, read_only, timeout_ms, offset)
                 
-                # اگر کوئری داده برمی‌گرداند
-                if result.returns_rows:
-                    columns = result.keys()
-                    rows = result.fetchall()
-                    output = {"columns": columns, "rows": rows}
+                if output["plan"] is not None:
+                    row_count = None
+                    flash("plan اجرای کوئری دریافت شد.", "success")
+                elif output["columns"] is not None:
+                    row_count = len(output["rows"])
                     flash("کوئری با موفقیت اجرا شد.", "success")
                 else:
-                    flash("کوئری اجرا شد (هیچ داده‌ای برگردانده نشد).", "info")
-                    
-        except Exception as e:
-            flash(f"خطا در اجرای کوئری: {str(e)}", "danger")
+                    row_count = output["rowcount"]
+                    flash(f"کوئری اجرا شد (هیچ داده‌ای برگردانده نشد، {output['rowcount']} ردیف تغییر کرد).", "info")
+                record_console_query(query_text, mode, output["elapsed_ms"], row_count)
+                        
+            except Exception as e:
+                elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+                record_console_query(query_text, mode, elapsed_ms, None, error=e)
+                flash(f"خطا در اجرای کوئری: {str(e)}", "danger")
+    
+    try:
+        saved_queries, slowest_queries = load_console_history()
+    except Exception as e:
+        app.logger.error(f"Error loading console history: {e}")
+        saved_queries, slowest_queries = [], []
     
-    return render_template("admin_query.html", output=output, query=query_text)
+    return render_template("admin_query.html",
+                         output=output,
+                         query=query_text,
+                         mode=mode,
+                         read_only=read_only,
+                         timeout_ms=timeout_ms,
+                         row_limit=ADMIN_QUERY_ROW_LIMIT,
+                         can_page=is_select_statement(query_text),
+                         saved_queries=saved_queries,
+                         slowest_queries=slowest_queries)
+
+@app.route("/admin/query/saved/<int:query_id>/delete", methods=["POST"])
+def admin_delete_saved_query(query_id):
+    if not session.get("admin_logged_in"):
+        flash("لطفاً به عنوان ادمین وارد شوید.", "warning")
+        return redirect(url_for("admin_login"))
+    
+    try:
+        with engine.begin() as conn:
+            result = conn.execute(
+                text("DELETE FROM admin_saved_queries WHERE id = :query_id"),
+                {"query_id": query_id}
+            )
+        if result.rowcount > 0:
+            audit("saved_query_delete", target=query_id)
+            flash("کوئری ذخیره‌شده حذف شد.", "success")
+        else:
+            flash("کوئری یافت نشد.", "warning")
+    except Exception as e:
+        flash(f"خطا در حذف کوئری: {str(e)}", "danger")
+    
+    return redirect(url_for("admin_query"))
 
 @app.route("/admin/submissions")
 def admin_submissions():
@@ -491,12 +3121,279 @@ def admin_submissions():
                          selected_hw=hw)
 
 
+@app.route("/admin/homeworks", methods=["GET", "POST"])
+def admin_homeworks():
+    if not session.get("admin_logged_in"):
+        flash("لطفاً به عنوان ادمین وارد شوید.", "warning")
+        return redirect(url_for("admin_login"))
+
+    if request.method == "POST":
+        # زمان‌ها در فرم به ساعت تهران وارد و به UTC ذخیره می‌شوند
+        updates = []
+        try:
+            for hw in HW_NUMBERS:
+                opens_at, closes_at = (
+                    tehran_to_utc(datetime.strptime(value, "%Y-%m-%dT%H:%M")) if value else None
+                    for value in (request.form.get(f"opens_at_{hw}", "").strip(),
+                                  request.form.get(f"closes_at_{hw}", "").strip())
+                )
+                if opens_at and closes_at and opens_at >= closes_at:
+                    raise ValueError(f"زمان بسته شدن تمرین {hw} باید بعد از زمان باز شدن باشد.")
+                updates.append({"hw": hw, "opens_at": opens_at, "closes_at": closes_at})
+        except ValueError as e:
+            flash(f"زمان نامعتبر: {e}", "danger")
+            return redirect(url_for("admin_homeworks"))
+
+        try:
+            with engine.begin() as conn:
+                ensure_homework_config_table(conn)
+                conn.execute(
+                    text("""
+                        UPDATE homework_config
+                        SET opens_at = :opens_at, closes_at = :closes_at, updated_at = CURRENT_TIMESTAMP
+                        WHERE hw = :hw
+                    """),
+                    updates,
+                )
+            homework_config.invalidate()
+            audit("homework_schedule_update", schedule=updates)
+            flash(f"زمان‌بندی تمرین‌ها ذخیره شد. سایر workerها حداکثر پس از {HOMEWORK_CONFIG_CACHE_SECONDS} ثانیه به‌روز می‌شوند.", "success")
+        except Exception as e:
+            app.logger.error(f"Error saving homework config: {e}")
+            flash(f"خطا در ذخیره زمان‌بندی: {e}", "danger")
+        return redirect(url_for("admin_homeworks"))
+
+    homework_config.invalidate()
+    config = homework_config.get()
+    now = datetime.utcnow()
+    homeworks = []
+    for hw in HW_NUMBERS:
+        opens_at, closes_at = config.get(hw, (None, None))
+        homeworks.append({
+            "hw": hw,
+            "status": homework_status(hw, now),
+            "opens_at": utc_to_tehran(opens_at).strftime("%Y-%m-%dT%H:%M") if opens_at else "",
+            "closes_at": utc_to_tehran(closes_at).strftime("%Y-%m-%dT%H:%M") if closes_at else "",
+        })
+    return render_template("admin_homeworks.html", homeworks=homeworks)
+
+@app.route("/admin/grading-policies", methods=["GET", "POST"])
+def admin_grading_policies():
+    if not session.get("admin_logged_in"):
+        flash("لطفاً به عنوان ادمین وارد شوید.", "warning")
+        return redirect(url_for("admin_login"))
+
+    if request.method == "POST":
+        hw = request.form.get("hw", "")
+        major = request.form.get("major", "")
+        try:
+            qnum = int(request.form.get("qnum", ""))
+            if hw not in HW_NUMBERS or (major and major not in MAJORS) or qnum < 1:
+                raise ValueError("تمرین، رشته یا شماره سؤال معتبر نیست.")
+            key = {"hw": hw, "qnum": qnum, "major": major}
+            if request.form.get("action") == "delete":
+                statement = "DELETE FROM grading_policies WHERE hw = :hw AND qnum = :qnum AND major = :major"
+                params = key
+                done_message = f"سیاست سؤال {qnum} تمرین {hw} حذف شد."
+            else:
+                # فیلد خالی یعنی مقدار پیش‌فرض (NULL)
+                def optional(name, cast):
+                    value = request.form.get(name, "").strip()
+                    return cast(value) if value else None
+                params = dict(
+                    key,
+                    order_matters=optional("order_matters", lambda v: v == "1"),
+                    tolerance=optional("tolerance", float),
+                    match_column_names=optional("match_column_names", lambda v: v == "1"),
+                    row_cap=optional("row_cap", int),
+                    timeout_ms=optional("timeout_ms", int),
+                )
+                if any(params[name] is not None and params[name] < 0 for name in ("tolerance", "row_cap", "timeout_ms")):
+                    raise ValueError("تلرانس، سقف ردیف و زمان نمی‌توانند منفی باشند.")
+                statement = """
+                    INSERT INTO grading_policies
+                        (hw, qnum, major, order_matters, tolerance, match_column_names, row_cap, timeout_ms)
+                    VALUES (:hw, :qnum, :major, :order_matters, :tolerance, :match_column_names, :row_cap, :timeout_ms)
+                    ON CONFLICT (hw, qnum, major) DO UPDATE SET
+                        order_matters = excluded.order_matters,
+                        tolerance = excluded.tolerance,
+                        match_column_names = excluded.match_column_names,
+                        row_cap = excluded.row_cap,
+                        timeout_ms = excluded.timeout_ms,
+                        updated_at = CURRENT_TIMESTAMP
+                """
+                done_message = f"سیاست سؤال {qnum} تمرین {hw} ذخیره شد."
+        except ValueError as e:
+            flash(f"مقدار نامعتبر: {e}", "danger")
+            return redirect(url_for("admin_grading_policies"))
+
+        try:
+            with engine.begin() as conn:
+                ensure_grading_policies_table(conn)
+                conn.execute(text(statement), params)
+            grading_policies.invalidate()
+            audit("grading_policy_" + ("delete" if request.form.get("action") == "delete" else "update"),
+                  target=f"hw{hw}_q{qnum}", **params)
+            flash(f"{done_message} سایر workerها حداکثر پس از {GRADING_POLICY_CACHE_SECONDS} ثانیه به‌روز می‌شوند.", "success")
+        except Exception as e:
+            app.logger.error(f"Error saving grading policy: {e}")
+            flash(f"خطا در ذخیره سیاست تصحیح: {e}", "danger")
+        return redirect(url_for("admin_grading_policies"))
+
+    try:
+        with engine.begin() as conn:
+            ensure_grading_policies_table(conn)
+            policies = conn.execute(text("""
+                SELECT hw, qnum, major, order_matters, tolerance, match_column_names, row_cap, timeout_ms, updated_at
+                FROM grading_policies ORDER BY hw, qnum, major
+            """)).mappings().all()
+    except Exception as e:
+        flash(f"خطا در بارگذاری سیاست‌های تصحیح: {e}", "danger")
+        policies = []
+    return render_template("admin_grading_policies.html", policies=policies, hw_numbers=HW_NUMBERS,
+                           majors=MAJORS, defaults=DEFAULT_GRADING_POLICY)
+
+@app.route("/admin/gradebook")
+def admin_gradebook():
+    if not session.get("admin_logged_in"):
+        flash("لطفاً به عنوان ادمین وارد شوید.", "warning")
+        return redirect(url_for("admin_login"))
+
+    mode = request.args.get("mode", "best")
+    major = request.args.get("major", "")
+
+    try:
+        students = load_gradebook(mode, major)
+    except Exception as e:
+        flash(f"خطا در بارگذاری دفتر نمره: {e}", "danger")
+        students = []
+
+    return render_template("admin_gradebook.html",
+                         students=students,
+                         hw_numbers=HW_NUMBERS,
+                         majors=MAJORS,
+                         mode=mode,
+                         selected_major=major)
+
+@app.route("/admin/gradebook/refresh", methods=["POST"])
+def admin_gradebook_refresh():
+    if not session.get("admin_logged_in"):
+        flash("لطفاً به عنوان ادمین وارد شوید.", "warning")
+        return redirect(url_for("admin_login"))
+
+    try:
+        with engine.begin() as conn:
+            count = refresh_gradebook(conn)
+        audit("gradebook_refresh", rows=count)
+        flash(f"دفتر نمره بازسازی شد ({count} ردیف).", "success")
+    except Exception as e:
+        app.logger.error(f"Error refreshing gradebook: {e}")
+        flash(f"خطا در بازسازی دفتر نمره: {e}", "danger")
+
+    return redirect(url_for("admin_gradebook"))
+
+@app.route("/admin/gradebook/export")
+def admin_gradebook_export():
+    if not session.get("admin_logged_in"):
+        flash("لطفاً به عنوان ادمین وارد شوید.", "warning")
+        return redirect(url_for("admin_login"))
+
+    mode = request.args.get("mode", "best")
+    major = request.args.get("major", "")
+    students = load_gradebook(mode, major)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["student_id", "name", "major"] + [f"hw{hw}" for hw in HW_NUMBERS])
+    for student in students:
+        writer.writerow(
+            [student["student_id"], student["name"], student["major"]]
+            + [student["scores"].get(hw, "") for hw in HW_NUMBERS]
+        )
+
+    # BOM برای نمایش درست حروف فارسی در اکسل
+    return Response(
+        "\ufeff" + buffer.getvalue(),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename=gradebook_{mode}.csv"},
+    )
+
+
+
+@app.route("/admin/references", methods=["GET", "POST"])
+def admin_references():
+    if not session.get("admin_logged_in"):
+        flash("لطفاً به عنوان ادمین وارد شوید.", "warning")
+        return redirect(url_for("admin_login"))
+    
+    if request.method == "POST":
+        hw = request.form.get("hw")
+        major = request.form.get("major")
+        solution_sql = request.form.get("solution_sql", "")
+        file = request.files.get("solution_file")
+        if file and file.filename:
+            solution_sql = file.stream.read().decode("utf-8")
+        
+        if hw not in HW_NUMBERS or major not in MAJORS:
+            flash("تمرین و رشته معتبر انتخاب کنید.", "danger")
+            return redirect(url_for("admin_references"))
+        if not solution_sql.strip():
+            flash("متن SQL حل تمرین خالی است.", "danger")
+            return redirect(url_for("admin_references"))
+        
+        try:
+            summaries = materialize_references(hw, major, solution_sql)
+            grading_snapshot_changed()
+            audit("references_upload", target=f"hw{hw}", major=major, questions=len(summaries))
+            flash(f"{len(summaries)} جدول مرجع برای تمرین {hw} ({major}) ساخته شد.", "success")
+        except Exception as e:
+            app.logger.error(f"Error materializing references for hw{hw}: {e}")
+            flash(f"خطا در ساخت جدول‌های مرجع: {str(e)}", "danger")
+        return redirect(url_for("admin_references"))
+    
+    try:
+        with engine.begin() as conn:
+            ensure_reference_meta_table(conn)
+            references = conn.execute(text("""
+                SELECT hw, suffix, qnum, table_name, row_count, distinct_count, column_count,
+                       column_names, column_types, content_hash, created_at
+                FROM reference_meta
+                ORDER BY hw, suffix, qnum
+            """)).mappings().all()
+    except Exception as e:
+        flash(f"خطا در بارگذاری جدول‌های مرجع: {e}", "danger")
+        references = []
+    
+    return render_template("admin_references.html",
+                         references=references,
+                         majors=MAJORS,
+                         hw_numbers=HW_NUMBERS)
 
 @app.route("/admin/logout")
 def admin_logout():
     session.pop("admin_logged_in", None)
     flash("خروج از پنل ادمین موفقیت‌آمیز بود.", "success")
     return redirect(url_for("admin_login"))
+def render_manage_users(import_report=None):
+    """صفحه اول لیست کاربران با جستجوی فعلی؛ پس از ورود فایل، گزارش آن هم نمایش داده می‌شود"""
+    q = request.args.get("q", "").strip()
+    major = request.args.get("major", "")
+    
+    # دریافت صفحه اول کاربران؛ صفحه‌های بعدی از /admin/users.json خوانده می‌شوند
+    try:
+        users, next_after = fetch_users(q, major)
+    except Exception as e:
+        flash(f"خطا در دریافت لیست کاربران: {str(e)}", "danger")
+        users, next_after = [], None
+    
+    return render_template("admin_manage_users.html",
+                         users=users,
+                         next_after=next_after,
+                         q=q,
+                         majors=MAJORS,
+                         selected_major=major,
+                         import_report=import_report)
+
 @app.route("/admin/manage_users", methods=["GET", "POST"])
 def admin_manage_users():
     if not session.get("admin_logged_in"):
@@ -528,23 +3425,128 @@ def admin_manage_users():
                     text("UPDATE stuid SET pass = :password WHERE student_id = :student_id"),
                     {"password": new_password, "student_id": student_id}
                 )
+                audit("password_reset", target=student_id)
                 
                 flash(f"رمز عبور دانشجو {student[1]} با موفقیت تغییر یافت.", "success")
                 
         except Exception as e:
             flash(f"خطا در تغییر رمز عبور: {str(e)}", "danger")
+        
+        # Post/Redirect/Get: بعد از تغییر رمز فقط صفحه اول دوباره بارگذاری می‌شود
+        return redirect(url_for("admin_manage_users", q=request.args.get("q", ""), major=request.args.get("major", "")))
+    
+    return render_manage_users()
+
+@app.route("/admin/users.json")
+def admin_users_json():
+    if not session.get("admin_logged_in"):
+        return jsonify({"error": "unauthorized"}), 401
     
-    # دریافت لیست کاربران
+    limit = min(max(request.args.get("limit", type=int, default=USERS_PAGE_SIZE), 1), 500)
     try:
+        users, next_after = fetch_users(
+            request.args.get("q", "").strip(),
+            request.args.get("major", ""),
+            request.args.get("after", ""),
+            limit,
+        )
+    except Exception as e:
+        app.logger.error(f"Error fetching users page: {e}")
+        return jsonify({"error": str(e)}), 500
+    return jsonify({"users": users, "next_after": next_after})
+
+@app.route("/admin/users/bulk", methods=["POST"])
+def admin_bulk_users():
+    if not session.get("admin_logged_in"):
+        flash("لطفاً به عنوان مدرس وارد شوید.", "warning")
+        return redirect(url_for("admin_login"))
+    
+    action = request.form.get("action", "")
+    scope = request.form.get("scope", "selected")
+    q = request.form.get("q", "").strip()
+    major = request.form.get("major", "")
+    back = redirect(url_for("admin_manage_users", q=q, major=major))
+    
+    # انتخاب دانشجویان: یا تیک‌های جدول یا همه نتایج جستجوی فعلی
+    if scope == "filter":
+        if not q and not major and request.form.get("confirm_all") != "1":
+            flash("برای اعمال روی همه دانشجویان، گزینه تأیید را علامت بزنید.", "danger")
+            return back
+        where, params = user_filter_clause(q, major)
+        statement_binds = []
+    else:
+        student_ids = [sid for sid in request.form.getlist("student_ids") if sid]
+        if not student_ids:
+            flash("هیچ دانشجویی انتخاب نشده است.", "danger")
+            return back
+        where = "student_id IN :student_ids"
+        params = {"student_ids": student_ids}
+        statement_binds = [bindparam("student_ids", expanding=True)]
+    
+    if action == "reset_password":
+        if request.form.get("password_mode") == "student_id":
+            set_clause = "pass = student_id"
+        else:
+            new_password = request.form.get("new_password", "").strip()
+            if not new_password:
+                flash("رمز عبور جدید را وارد کنید.", "danger")
+                return back
+            set_clause = "pass = :new_password"
+            params["new_password"] = new_password
+        statement = f"UPDATE stuid SET {set_clause} WHERE {where}"
+        done_message = "رمز عبور {count} دانشجو بازنشانی شد."
+    elif action == "change_major":
+        new_major = request.form.get("new_major", "")
+        if new_major not in MAJORS:
+            flash("رشته جدید معتبر نیست.", "danger")
+            return back
+        statement = f"UPDATE stuid SET major = :new_major WHERE {where}"
+        params["new_major"] = new_major
+        done_message = "رشته {count} دانشجو تغییر کرد."
+    elif action == "delete":
+        statement = f"DELETE FROM stuid WHERE {where}"
+        done_message = "{count} دانشجو حذف شد."
+    else:
+        flash("عملیات نامعتبر است.", "danger")
+        return back
+    
+    try:
+        # یک دستور و یک تراکنش برای کل مجموعه
         with engine.begin() as conn:
-            users = conn.execute(
-                text("SELECT student_id, name, major, email FROM stuid ORDER BY student_id")
-            ).fetchall()
+            result = conn.execute(text(statement).bindparams(*statement_binds), params)
+        audit(f"bulk_{action}", scope=scope, q=q, major=major, new_major=params.get("new_major"),
+              student_ids=params.get("student_ids"), count=result.rowcount)
+        flash(done_message.format(count=result.rowcount), "success" if result.rowcount else "warning")
     except Exception as e:
-        flash(f"خطا در دریافت لیست کاربران: {str(e)}", "danger")
-        users = []
+        app.logger.error(f"Error in bulk user action {action}: {e}")
+        flash(f"خطا در اجرای عملیات گروهی: {str(e)}", "danger")
     
-    return render_template("admin_manage_users.html", users=users)
+    return back
+
+@app.route("/admin/import_users", methods=["POST"])
+def admin_import_users():
+    if not session.get("admin_logged_in"):
+        flash("لطفاً به عنوان مدرس وارد شوید.", "warning")
+        return redirect(url_for("admin_login"))
+    
+    file = request.files.get("roster_file")
+    if not file or not file.filename:
+        flash("لطفاً فایل CSV را انتخاب کنید.", "danger")
+        return redirect(url_for("admin_manage_users"))
+    
+    try:
+        started = time.perf_counter()
+        imported, errors = import_roster(file.stream)
+        elapsed = time.perf_counter() - started
+        audit("roster_import", target=file.filename, imported=imported, errors=len(errors))
+        flash(f"{imported} دانشجو در {elapsed:.2f} ثانیه وارد یا به‌روزرسانی شد؛ {len(errors)} ردیف خطا داشت.",
+              "success" if not errors else "warning")
+    except Exception as e:
+        app.logger.error(f"Error importing roster: {e}")
+        flash(f"خطا در ورود فایل: {str(e)}", "danger")
+        return redirect(url_for("admin_manage_users"))
+    
+    return render_manage_users(import_report={"imported": imported, "errors": errors})
 
 @app.route("/admin/delete_user/<student_id>")
 def admin_delete_user(student_id):
@@ -561,6 +3563,7 @@ def admin_delete_user(student_id):
             )
             
             if result.rowcount > 0:
+                audit("user_delete", target=student_id)
                 flash("کاربر با موفقیت حذف شد.", "success")
             else:
                 flash("کاربر یافت نشد.", "warning")
@@ -689,6 +3692,7 @@ def admin_allowed_tables():
                     text("INSERT INTO allowed_tables (table_name, description) VALUES (:table_name, :description)"),
                     {"table_name": table_name, "description": description}
                 )
+            audit("allowed_table_add", target=table_name)
             flash(f"جدول '{table_name}' با موفقیت اضافه شد.", "success")
             return redirect(url_for("admin_allowed_tables"))
         except Exception as e:
@@ -722,6 +3726,7 @@ def admin_delete_table(table_id):
             )
             
             if result.rowcount > 0:
+                audit("allowed_table_delete", target=table_id)
                 flash("جدول با موفقیت حذف شد.", "success")
                 app.logger.info(f"Table {table_id} deleted successfully")
             else:
@@ -735,15 +3740,18 @@ def admin_delete_table(table_id):
     return redirect(url_for("admin_allowed_tables"))
 
 # تابع کمکی برای بررسی مجاز بودن جدول
+def table_is_allowed(conn, table_name) -> bool:
+    result = conn.execute(
+        text("SELECT table_name FROM allowed_tables WHERE table_name = :table_name"),
+        {"table_name": table_name}
+    ).fetchone()
+    return result is not None
+
 def is_table_allowed(table_name):
     """بررسی می‌کند که آیا جدول در لیست جدول‌های مجاز است"""
     try:
         with engine.begin() as conn:
-            result = conn.execute(
-                text("SELECT table_name FROM allowed_tables WHERE table_name = :table_name"),
-                {"table_name": table_name}
-            ).fetchone()
-            return result is not None
+            return table_is_allowed(conn, table_name)
     except Exception as e:
         app.logger.error(f"Error checking allowed table {table_name}: {str(e)}")
         return False
@@ -810,6 +3818,7 @@ def debug_tables_data():
 
 # اصلاح تابع run_test_query برای استفاده از جدول‌های مجاز
 @app.route("/run_test_query", methods=["GET", "POST"])
+@rate_limited("run_test_query")
 def run_test_query():
     if "student_id" not in session:
         flash("ابتدا وارد شوید.", "warning")
@@ -846,7 +3855,10 @@ def run_test_query():
             return render_template("test_sql_runner.html", error=error, query=query_text)
 
         try:
-            with engine.begin() as conn:
+            with grading_admission.slot(owner=session["student_id"]), \
+                    guarded_connection(grading_engine, read_only=True,
+                                       timeout_ms=GRADING_STATEMENT_TIMEOUT_MS, commit=False) as conn:
+                guard_query_plan(conn, query_text)
                 result = conn.execute(text(query_text))
                 columns = list(result.keys())
                 rows = result.fetchall()
@@ -867,8 +3879,17 @@ def run_test_query():
                     "rows": serializable_rows
                 }, ensure_ascii=False, default=str)
                 
+        except AdmissionRejected as busy:
+            error = busy.message
+            response = Response(render_template("test_sql_runner.html", query=query_text, error=error), status=busy.status)
+            response.headers["Retry-After"] = str(busy.retry_after)
+            return response
+        except QueryPlanRejected as e:
+            error = f"کوئری اجرا نشد: {e}"
         except Exception as e:
             error = f"خطا در اجرای SQL: {e}"
+        audit("test_query", target=table_name, query_hash=query_fingerprint(query_text),
+              rows=len(output["rows"]) if output else None, error=error)
 
     return render_template("test_sql_runner.html", output=output, query=query_text, error=error)
 
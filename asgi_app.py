@@ -0,0 +1,396 @@
+"""اجرای async روت‌های دانشجو (ورود، داشبورد، ارسال، نتیجه و اجرای کوئری آزمایشی) روی ASGI.
+
+    hypercorn asgi_app:application --workers 2 --bind 0.0.0.0:8000
+
+این روت‌ها با Quart و engine async در SQLAlchemy اجرا می‌شوند تا کوئری کند یک دانشجو
+worker را قفل نکند؛ بقیه روت‌ها (ادمین، /metrics و ...) بدون تغییر از همان اپلیکیشن
+Flask در app.py از طریق WSGI سرو می‌شوند. session بین دو بخش مشترک است چون هر دو
+کوکی را با همان SECRET_KEY امضا می‌کنند. منطق تصحیح و کوئری‌ها با run_sync از app.py
+استفاده می‌شود.
+"""
+import asyncio
+import json
+import math
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from quart import Quart, flash, g, redirect, render_template, request, session, url_for
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app import (
+    DB_URI, EFFICIENCY_SCORING, GRADING_BACKEND, GRADING_DB_URI, GRADING_STATEMENT_TIMEOUT_MS,
+    HOMEWORK_CLOSED_MESSAGES, MAJORS, MAX_SUBMISSIONS, REQUEST_LATENCY, AdmissionRejected, QueryPlanRejected,
+    apply_statement_guards, audit, check_rate_limit, count_submissions, create_app, efficiency_summary,
+    fetch_reference_meta, find_student, format_datetime_fa, grade_submission, grading_admission,
+    grading_engine, grading_policies, guard_query_plan, guarded_connection, history_cache, homework_priority,
+    homework_status, instrument_engine, open_homeworks, parse_queries, query_fingerprint,
+    record_submission, reference_suffix, refresh_grading_snapshot, table_is_allowed,
+)
+
+flask_app = create_app()
+
+# ==================== engineهای async ====================
+
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+def make_async_engine(name: str, uri: str, prefix: str, pool_size: int = 5, max_overflow: int = 10,
+                      pool_recycle: int = 1800, pool_timeout: float = 30):
+    """معادل async تابع make_engine با همان متغیرهای محیطی pool"""
+    url = make_url(uri)
+    backend = url.get_backend_name()
+    url = url.set(drivername=ASYNC_DRIVERS.get(backend, url.drivername))
+    options = {"pool_pre_ping": True}
+    if backend != "sqlite":
+        options.update(
+            pool_size=int(os.environ.get(f"{prefix}_POOL_SIZE", pool_size)),
+            max_overflow=int(os.environ.get(f"{prefix}_MAX_OVERFLOW", max_overflow)),
+            pool_recycle=int(os.environ.get(f"{prefix}_POOL_RECYCLE", pool_recycle)),
+            pool_timeout=float(os.environ.get(f"{prefix}_POOL_TIMEOUT", pool_timeout)),
+        )
+    bind = create_async_engine(url, **options)
+    instrument_engine(bind.sync_engine, name)
+    return bind
+
+async_engine = make_async_engine("async_app", DB_URI, "DB")
+async_grading_engine = make_async_engine(
+    "async_grading", GRADING_DB_URI, "GRADING_DB", max_overflow=5, pool_timeout=5
+)
+
+@asynccontextmanager
+async def guarded_async_connection(bind, read_only: bool = False, timeout_ms: int = 0):
+    """معادل async تابع guarded_connection؛ همه تغییرات در پایان برگردانده می‌شوند"""
+    async with bind.connect() as conn:
+        sqlite = conn.dialect.name == "sqlite"
+        trans = await conn.begin()
+        driver = None
+        try:
+            # progress handler در aiosqlite خودش async است؛ مهلت SQLite جدا تنظیم می‌شود
+            await conn.run_sync(apply_statement_guards, read_only, 0 if sqlite else timeout_ms)
+            if sqlite and timeout_ms:
+                driver = (await conn.get_raw_connection()).driver_connection
+                deadline = time.monotonic() + timeout_ms / 1000
+                await driver.set_progress_handler(lambda: 1 if time.monotonic() > deadline else 0, 10000)
+            yield conn
+        finally:
+            await trans.rollback()
+            if sqlite and read_only:
+                await conn.exec_driver_sql("PRAGMA query_only = OFF")
+            if driver is not None:
+                await driver.set_progress_handler(None, 0)
+
+async def run_on_grading(fn, *args):
+    """اجرای fn(conn, *args) روی اتصال فقط‌خواندنی تصحیح"""
+    if GRADING_BACKEND == "snapshot":
+        # snapshot یک پایگاه SQLite درون پردازه است؛ اجرای آن در thread همان کاری است که aiosqlite می‌کند
+        def call():
+            with guarded_connection(grading_engine, read_only=True,
+                                    timeout_ms=GRADING_STATEMENT_TIMEOUT_MS, commit=False) as conn:
+                return fn(conn, *args)
+        return await asyncio.to_thread(call)
+
+    async with guarded_async_connection(async_grading_engine, read_only=True,
+                                        timeout_ms=GRADING_STATEMENT_TIMEOUT_MS) as conn:
+        return await conn.run_sync(fn, *args)
+
+@asynccontextmanager
+async def grading_slot(priority=math.inf, owner=None):
+    """همان کنترل پذیرش نسخه sync؛ انتظار در صف در thread جدا انجام می‌شود تا event loop آزاد بماند"""
+    ticket = await asyncio.to_thread(grading_admission.acquire, priority, owner)
+    try:
+        yield
+    finally:
+        grading_admission.release(ticket)
+
+def execute_query(conn, query_text: str):
+    guard_query_plan(conn, query_text)
+    result = conn.execute(text(query_text))
+    return list(result.keys()), result.fetchall()
+
+# ==================== اپلیکیشن Quart ====================
+
+async_app = Quart(
+    __name__,
+    template_folder=flask_app.template_folder,
+    static_folder=flask_app.static_folder,
+)
+async_app.secret_key = flask_app.secret_key
+for key in ("SESSION_COOKIE_NAME", "SESSION_COOKIE_SECURE", "SESSION_COOKIE_HTTPONLY",
+            "SESSION_COOKIE_SAMESITE", "PERMANENT_SESSION_LIFETIME"):
+    async_app.config[key] = flask_app.config[key]
+
+ASYNC_ENDPOINTS = ("login", "dashboard", "submit", "result", "run_test_query")
+
+@async_app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@async_app.after_request
+async def observe_request(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        REQUEST_LATENCY.labels(
+            request.endpoint or "unknown", request.method, str(response.status_code)
+        ).observe(time.perf_counter() - started)
+    return response
+
+async def rate_limit_response(route: str):
+    """همان محدودیت نرخ نسخه sync؛ None اگر درخواست مجاز باشد"""
+    retry_after = await asyncio.to_thread(
+        check_rate_limit, route, session.get("student_id"), request.remote_addr
+    )
+    if retry_after is None:
+        return None
+    body = await render_template("rate_limited.html", retry_after=retry_after)
+    return body, 429, {"Retry-After": str(retry_after)}
+
+async def busy_response(busy: AdmissionRejected):
+    body = await render_template("busy.html", position=busy.position, retry_after=busy.retry_after, reason=busy.reason)
+    return body, busy.status, {"Retry-After": str(busy.retry_after)}
+
+@async_app.route("/", methods=["GET", "POST"])
+async def login():
+    if request.method == "POST":
+        form = await request.form
+        student_id = form.get("student_id", "").strip()
+        password = form.get("password", "").strip()
+        if not student_id or not password:
+            await flash("لطفاً شماره دانشجویی و رمز عبور را وارد کنید.", "danger")
+            return redirect(url_for("login"))
+
+        try:
+            async with async_engine.connect() as conn:
+                name, major = await conn.run_sync(find_student, student_id, password)
+        except Exception as e:
+            async_app.logger.error(f"Auth error: {e}")
+            name, major = None, None
+        if not name:
+            audit("login_failed", actor=student_id, role="student", ip=request.remote_addr)
+            await flash("شماره دانشجویی یا رمز عبور اشتباه است.", "danger")
+            return redirect(url_for("login"))
+
+        session["student_id"] = student_id
+        session["name"] = name
+        session["major"] = major
+        audit("login", actor=student_id, role="student", ip=request.remote_addr)
+        return redirect(url_for("dashboard"))
+
+    return await render_template("login.html")
+
+@async_app.route("/dashboard")
+async def dashboard():
+    if "student_id" not in session:
+        await flash("ابتدا وارد شوید.", "warning")
+        return redirect(url_for("login"))
+    return await render_template(
+        "dashboard.html",
+        name=session["name"],
+        student_id=session["student_id"],
+        major=session["major"]
+    )
+
+@async_app.route("/submit", methods=["GET", "POST"])
+async def submit():
+    if "student_id" not in session:
+        await flash("لطفاً ابتدا وارد شوید.", "warning")
+        return redirect(url_for("login"))
+
+    student_id = session["student_id"]
+    name = session["name"]
+    major = session["major"]
+
+    if request.method == "GET":
+        # بارگذاری دوباره زمان‌بندی از دیتابیس (هر چند ثانیه یک بار) event loop را نگه ندارد
+        homeworks = [(hw, format_datetime_fa(closes_at) if closes_at else None)
+                     for hw, closes_at in await asyncio.to_thread(open_homeworks)]
+        return await render_template("submit.html", majors=MAJORS, homeworks=homeworks, name=name, student_id=student_id, major=major)
+
+    limited = await rate_limit_response("submit")
+    if limited:
+        return limited
+
+    form = await request.form
+    files = await request.files
+    hw = form.get("hw")
+    sql_text = form.get("sql_text", "")
+    file = files.get("sql_file")
+
+    status = await asyncio.to_thread(homework_status, hw)
+    if status is None:
+        await flash("تمرین معتبر انتخاب کنید.", "danger")
+        return redirect(url_for("submit"))
+    if status != "open":
+        await flash(HOMEWORK_CLOSED_MESSAGES[status].format(hw=hw), "warning")
+        return redirect(url_for("submit"))
+
+    try:
+        async with async_engine.connect() as conn:
+            submission_count = await conn.run_sync(count_submissions, student_id, hw)
+    except Exception as e:
+        async_app.logger.error(f"Error getting submission count: {e}")
+        submission_count = 0
+    if submission_count >= MAX_SUBMISSIONS:
+        await flash(f"شما قبلاً ۱۰ بار تمرین {hw} را ارسال کرده‌اید.", "warning")
+        return redirect(url_for("submit"))
+
+    if file and file.filename:
+        if not file.filename.lower().endswith(".sql"):
+            await flash("فایل معتبر .sql ارسال کنید.", "danger")
+            return redirect(url_for("submit"))
+        sql_text = file.read().decode("utf-8")
+
+    if not sql_text.strip():
+        await flash("متن SQL خالی است.", "danger")
+        return redirect(url_for("submit"))
+
+    queries = parse_queries(sql_text)
+
+    if GRADING_BACKEND == "snapshot":
+        # اثر انگشت مرجع‌ها در تصحیح از خود snapshot خوانده می‌شود
+        reference_meta = None
+        await asyncio.to_thread(refresh_grading_snapshot)
+    else:
+        try:
+            async with async_engine.begin() as conn:
+                reference_meta = await conn.run_sync(fetch_reference_meta, hw, reference_suffix(major))
+        except Exception as e:
+            async_app.logger.error(f"Error loading reference meta for hw{hw}: {e}")
+            reference_meta = {}
+
+    # سیاست‌ها از کش خوانده می‌شوند؛ بارگذاری دوباره از دیتابیس event loop را نگه ندارد
+    policies = await asyncio.to_thread(grading_policies.get)
+
+    rejected = []
+    details = [] if EFFICIENCY_SCORING else None
+    try:
+        async with grading_slot(homework_priority(hw), owner=student_id):
+            correct_count, incorrect_questions = await run_on_grading(
+                grade_submission, hw, major, queries, reference_meta, rejected, details, policies
+            )
+    except AdmissionRejected as busy:
+        return await busy_response(busy)
+    for qnum, reason in rejected:
+        await flash(f"سؤال {qnum} اجرا نشد: {reason}", "warning")
+
+    async with async_engine.begin() as conn:
+        await conn.run_sync(record_submission, student_id, name, major, hw, correct_count, details)
+    history_cache.invalidate(student_id)
+    session["history_version"] = session.get("history_version", 0) + 1
+    audit("submission", target=f"hw{hw}", actor=student_id, role="student", ip=request.remote_addr,
+          correct=correct_count, total=len(queries), incorrect=incorrect_questions,
+          rejected=[qnum for qnum, _ in rejected])
+
+    new_submission_count = submission_count + 1
+    session["result"] = {
+        "name": name,
+        "student_id": student_id,
+        "major": major,
+        "hw": hw,
+        "total": len(queries),
+        "correct": correct_count,
+        "incorrect": incorrect_questions,
+        "done": new_submission_count,
+        "remaining": MAX_SUBMISSIONS - new_submission_count,
+        "time": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+        "efficiency": efficiency_summary(details),
+    }
+    return redirect(url_for("result"))
+
+@async_app.route("/result")
+async def result():
+    data = session.get("result")
+    if not data:
+        return redirect(url_for("submit"))
+
+    if "time" in data and data["time"]:
+        data["time_fa"] = format_datetime_fa(data["time"])
+    else:
+        data["time_fa"] = "نامشخص"
+
+    return await render_template("result.html", **data)
+
+@async_app.route("/run_test_query", methods=["GET", "POST"])
+async def run_test_query():
+    if "student_id" not in session:
+        await flash("ابتدا وارد شوید.", "warning")
+        return redirect(url_for("login"))
+
+    output = None
+    query_text = ""
+    error = None
+
+    if request.method == "POST":
+        limited = await rate_limit_response("run_test_query")
+        if limited:
+            return limited
+
+        form = await request.form
+        if "send_to_teacher" in form:
+            return redirect(url_for("send_to_teacher"))
+
+        query_text = form.get("query", "").strip()
+        if not query_text.lower().startswith("select"):
+            error = "فقط دستورات SELECT مجاز است."
+            return await render_template("test_sql_runner.html", error=error, query=query_text)
+
+        table_match = re.search(r'from\s+(\w+)', query_text, re.IGNORECASE)
+        if not table_match:
+            error = "نام جدول در کوئری یافت نشد."
+            return await render_template("test_sql_runner.html", error=error, query=query_text)
+
+        table_name = table_match.group(1)
+        try:
+            async with async_engine.connect() as conn:
+                allowed = await conn.run_sync(table_is_allowed, table_name)
+        except Exception as e:
+            async_app.logger.error(f"Error checking allowed table {table_name}: {e}")
+            allowed = False
+        if not allowed:
+            error = f"دسترسی به جدول '{table_name}' مجاز نیست."
+            return await render_template("test_sql_runner.html", error=error, query=query_text)
+
+        try:
+            async with grading_slot(owner=session["student_id"]):
+                columns, rows = await run_on_grading(execute_query, query_text)
+            output = {"columns": columns, "rows": rows}
+            session["teacher_query"] = query_text
+            session["teacher_output"] = json.dumps({
+                "columns": columns,
+                "rows": [row._asdict() for row in rows],
+            }, ensure_ascii=False, default=str)
+        except AdmissionRejected as busy:
+            error = busy.message
+            body = await render_template("test_sql_runner.html", query=query_text, error=error)
+            return body, busy.status, {"Retry-After": str(busy.retry_after)}
+        except QueryPlanRejected as e:
+            error = f"کوئری اجرا نشد: {e}"
+        except Exception as e:
+            error = f"خطا در اجرای SQL: {e}"
+        audit("test_query", target=table_name, actor=session["student_id"], role="student",
+              ip=request.remote_addr, query_hash=query_fingerprint(query_text),
+              rows=len(output["rows"]) if output else None, error=error)
+
+    return await render_template("test_sql_runner.html", output=output, query=query_text, error=error)
+
+# url_for در قالب‌ها به روت‌های Flask هم اشاره می‌کند؛ فقط برای ساخت آدرس ثبت می‌شوند
+for rule in flask_app.url_map.iter_rules():
+    if rule.endpoint not in async_app.view_functions:
+        async_app.url_map.add(async_app.url_rule_class(rule.rule, endpoint=rule.endpoint, methods=rule.methods))
+
+# ==================== تقسیم درخواست‌ها بین ASGI و WSGI ====================
+
+ASYNC_PATHS = {
+    rule.rule for rule in flask_app.url_map.iter_rules() if rule.endpoint in ASYNC_ENDPOINTS
+}
+wsgi_fallback = AsyncioWSGIMiddleware(flask_app)
+
+async def application(scope, receive, send):
+    if scope["type"] == "http" and scope["path"] not in ASYNC_PATHS:
+        await wsgi_fallback(scope, receive, send)
+    else:
+        await async_app(scope, receive, send)
@@ -0,0 +1,191 @@
+"""مقایسه استقرار sync (gunicorn) و async (hypercorn + asgi_app) با حافظه برابر.
+
+    python bench_async.py --student-id 1001 --password pw --memory-mb 512 --clients 64
+
+برای هر حالت ابتدا مصرف حافظه یک worker اندازه‌گیری می‌شود و تعداد workerها طوری
+انتخاب می‌شود که مجموع حافظه در حد --memory-mb بماند. سپس هر کلاینت به تناوب یک
+کوئری کند در /run_test_query و یک درخواست سبک /dashboard می‌فرستد؛ تأخیر درخواست‌های
+سبک نشان می‌دهد کوئری‌های کند چقدر بقیه کاربران را معطل می‌کنند.
+متغیرهای محیطی DB_URI و ... همان‌طور که هستند به سرورها داده می‌شوند، به جز BENCH_ENV:
+همه کلاینت‌ها با یک دانشجو و از یک IP وصل می‌شوند، پس سقف کار هم‌زمان هر دانشجو
+(GRADING_MAX_PER_STUDENT) و محدودیت‌های نرخ RATE_LIMIT_* خاموش می‌شوند؛ وگرنه تقریباً
+همه کوئری‌های کند هم‌زمان 429 می‌گیرند و به جای تأخیر، خطا اندازه‌گیری می‌شود.
+"""
+import argparse
+import http.client
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+# همه کلاینت‌ها یک دانشجو و یک IP هستند؛ محدودیت‌های هر دانشجو/IP بار را به 429 تبدیل می‌کنند
+BENCH_ENV = {
+    "GRADING_MAX_PER_STUDENT": "0",
+    "RATE_LIMIT_RUN_TEST_QUERY_STUDENT": "0",
+    "RATE_LIMIT_RUN_TEST_QUERY_IP": "0",
+    "RATE_LIMIT_SUBMIT_STUDENT": "0",
+    "RATE_LIMIT_SUBMIT_IP": "0",
+}
+
+def process_tree_rss_mb(pid: int) -> float:
+    """مجموع RSS یک پردازه و همه فرزندانش از /proc"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            children.setdefault(ppid, []).append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+
+    total_kb = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        stack.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+        except OSError:
+            continue
+    return total_kb / 1024
+
+def server_command(mode: str, workers: int, threads: int, port: int):
+    if mode == "sync":
+        return [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+                "--workers", str(workers), "--threads", str(threads), "--bind", f"127.0.0.1:{port}"]
+    return [sys.executable, "-m", "hypercorn", "asgi_app:application",
+            "--workers", str(workers), "--bind", f"127.0.0.1:{port}"]
+
+def start_server(mode: str, workers: int, threads: int, port: int):
+    proc = subprocess.Popen(
+        server_command(mode, workers, threads, port),
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env={**os.environ, **BENCH_ENV},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/")
+            conn.getresponse().read()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    stop_server(proc)
+    raise SystemExit(f"{mode} server did not start on port {port}")
+
+def stop_server(proc):
+    os.killpg(proc.pid, signal.SIGTERM)
+    proc.wait(timeout=30)
+
+class Client:
+    """یک کاربر با کوکی session خودش"""
+
+    def __init__(self, port: int):
+        self.port = port
+        self.cookie = ""
+
+    def request(self, method: str, path: str, form=None):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=120)
+        headers = {"Cookie": self.cookie} if self.cookie else {}
+        body = None
+        if form is not None:
+            body = urllib.parse.urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        started = time.perf_counter()
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        elapsed = time.perf_counter() - started
+        set_cookie = response.getheader("Set-Cookie")
+        if set_cookie:
+            self.cookie = set_cookie.split(";", 1)[0]
+        conn.close()
+        return response.status, elapsed
+
+def run_load(port: int, args):
+    latencies = {"slow": [], "light": []}
+    errors = {"slow": 0, "light": 0}
+    lock = threading.Lock()
+    stop_at = time.monotonic() + args.duration
+
+    def user():
+        client = Client(port)
+        client.request("POST", "/", {"student_id": args.student_id, "password": args.password})
+        while time.monotonic() < stop_at:
+            for kind, method, path, form in (
+                ("slow", "POST", "/run_test_query", {"query": args.query}),
+                ("light", "GET", "/dashboard", None),
+            ):
+                try:
+                    status, elapsed = client.request(method, path, form)
+                    ok = status == 200
+                except OSError:
+                    ok, elapsed = False, 0.0
+                with lock:
+                    if ok:
+                        latencies[kind].append(elapsed)
+                    else:
+                        errors[kind] += 1
+
+    with ThreadPoolExecutor(args.clients) as pool:
+        for _ in range(args.clients):
+            pool.submit(user)
+    return latencies, errors
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    return statistics.quantiles(values, n=100)[pct - 1] if len(values) > 1 else values[0]
+
+def benchmark(mode: str, port: int, args):
+    # حافظه یک worker (به اضافه پردازه اصلی) برای تعیین تعداد workerها
+    probe = start_server(mode, 1, args.threads, port)
+    time.sleep(2)
+    per_worker_mb = process_tree_rss_mb(probe.pid)
+    stop_server(probe)
+    workers = max(1, int(args.memory_mb // per_worker_mb))
+
+    proc = start_server(mode, workers, args.threads, port)
+    try:
+        latencies, errors = run_load(port, args)
+        rss_mb = process_tree_rss_mb(proc.pid)
+    finally:
+        stop_server(proc)
+
+    completed = len(latencies["slow"]) + len(latencies["light"])
+    print(f"{mode:5s} workers={workers:<3d} rss={rss_mb:7.1f}MB  req/s={completed / args.duration:7.1f}  "
+          f"light p50={percentile(latencies['light'], 50) * 1000:7.1f}ms p95={percentile(latencies['light'], 95) * 1000:7.1f}ms  "
+          f"slow p50={percentile(latencies['slow'], 50) * 1000:7.1f}ms p95={percentile(latencies['slow'], 95) * 1000:7.1f}ms  "
+          f"errors={errors['slow'] + errors['light']}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--student-id", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--query", default="SELECT * FROM students",
+                        help="کوئری کند؛ روی Postgres مثلاً SELECT pg_sleep(0.5) FROM students LIMIT 1")
+    parser.add_argument("--memory-mb", type=float, default=512)
+    parser.add_argument("--threads", type=int, default=4, help="threadهای هر worker در gunicorn")
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--port", type=int, default=8810)
+    parser.add_argument("--modes", default="sync,async")
+    args = parser.parse_args()
+
+    for offset, mode in enumerate(args.modes.split(",")):
+        benchmark(mode, args.port + offset, args)
+
+if __name__ == "__main__":
+    main()
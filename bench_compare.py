@@ -0,0 +1,78 @@
+"""مقایسه سرعت و درستی results_match با روش قدیمی set(student) == set(reference).
+
+    python bench_compare.py --rows 100000 --repeat 3
+
+برای هر سناریو دو نتیجه هم‌اندازه ساخته می‌شود (شناسه، نام، رشته، معدل و میانگین) و
+زمان هر روش و پاسخ آن چاپ می‌شود:
+  same      هر دو نتیجه با نوع‌های یکسان و ترتیب متفاوت
+  decimal   ستون‌های عددی مرجع Decimal (مثل numeric در Postgres) و دانشجو float با خطای گرد کردن
+  padded    نام‌ها در خروجی دانشجو با فاصله انتهایی (مثل CHAR(n))
+  wrong     یک معدل در خروجی دانشجو واقعاً متفاوت است
+"""
+import argparse
+import random
+import statistics
+import time
+from decimal import Decimal
+
+import app
+
+def make_rows(count: int, seed: int):
+    rng = random.Random(seed)
+    majors = ["علوم کامپیوتر", "آمار"]
+    rows = []
+    for i in range(count):
+        gpa = round(rng.uniform(10, 20), 2)
+        rows.append((i, f"student-{i}", majors[i % 2], gpa, sum(rng.random() for _ in range(3)) / 3))
+    return rows
+
+def scenarios(count: int):
+    reference = make_rows(count, seed=1)
+    shuffled = reference[:]
+    random.Random(2).shuffle(shuffled)
+
+    yield "same", shuffled, reference
+    yield "decimal", [
+        (i, name, major, gpa + 1e-12, avg * (1 + 1e-13)) for i, name, major, gpa, avg in shuffled
+    ], [
+        (i, name, major, Decimal(str(gpa)), Decimal(repr(avg))) for i, name, major, gpa, avg in reference
+    ]
+    yield "padded", [(i, name + "   ", major, gpa, avg) for i, name, major, gpa, avg in shuffled], reference
+    wrong = shuffled[:]
+    i, name, major, gpa, avg = wrong[count // 2]
+    wrong[count // 2] = (i, name, major, gpa + 0.5, avg)
+    yield "wrong", wrong, reference
+
+def timed(func, repeat: int):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        answer = func()
+        samples.append(time.perf_counter() - started)
+    return answer, statistics.median(samples)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=1e-6)
+    args = parser.parse_args()
+
+    methods = [("set", lambda s, r: set(s) == set(r))]
+    methods.append(("python", lambda s, r: app.results_match(s, r, args.tolerance)))
+    if app.np is not None:
+        methods.append(("numpy", lambda s, r: app.results_match(s, r, args.tolerance)))
+    else:
+        print("numpy نصب نیست؛ فقط مسیر پایتون خالص سنجیده می‌شود")
+
+    for name, student, reference in scenarios(args.rows):
+        line = [f"{name:8s}"]
+        for method, compare in methods:
+            # آستانه برداری فقط برای انتخاب مسیر در همین سنجش تغییر می‌کند
+            app.VECTORIZED_COMPARE_MIN_ROWS = 0 if method == "numpy" else float("inf")
+            answer, seconds = timed(lambda: compare(student, reference), args.repeat)
+            line.append(f"{method}={seconds * 1000:8.1f}ms ({'match' if answer else 'differ'})")
+        print("  ".join(line))
+
+if __name__ == "__main__":
+    main()
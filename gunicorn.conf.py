@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+import time
+
+# ==================== متریک‌های Prometheus ====================
+# هر worker مقادیر خود را در این پوشه می‌نویسد و /metrics همه را جمع می‌کند.
+# باید قبل از import شدن app در workerها تنظیم شود.
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "dbhw-prometheus")
+)
+# با preload، app قبل از hook on_starting import می‌شود؛ پس پوشه همین‌جا آماده می‌شود.
+# فقط در اولین بارگذاری پاک می‌شود، نه در reload با HUP که workerها هنوز در آن می‌نویسند.
+if "DBHW_METRICS_DIR_READY" not in os.environ:
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.environ["DBHW_METRICS_DIR_READY"] = "1"
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+# ==================== بارگذاری اپلیکیشن ====================
+# با preload ماژول app یک بار در پردازه اصلی import می‌شود و workerها فقط fork می‌شوند.
+# engineها lazy هستند و در post_fork رها می‌شوند، پس اتصالی بین workerها مشترک نمی‌ماند.
+wsgi_app = "app:create_app()"
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+    if server.cfg.preload_app:
+        from app import dispose_engines
+
+        dispose_engines(close=False)
+
+
+def post_worker_init(worker):
+    from app import GRADING_BACKEND, grading_engine
+
+    # snapshot تصحیح بعد از fork و قبل از اولین درخواست ساخته می‌شود
+    if GRADING_BACKEND == "snapshot":
+        grading_engine.get()
+    worker.log.info(
+        "Worker %s ready in %.3fs after fork", worker.pid, time.perf_counter() - worker.forked_at
+    )
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
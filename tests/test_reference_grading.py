@@ -0,0 +1,56 @@
+"""گزینه‌های اجرای اتصال پس از ساخت مرجع و تصحیح با اثر انگشت نباید عوض شوند.
+
+conn.execution_options(...) در SQLAlchemy 2.0 خود اتصال را تغییر می‌دهد؛ اگر stream_results
+روی اتصال بماند، در Postgres همه دستورهای بعدی (SAVEPOINT، EXPLAIN، SET LOCAL، INSERT)
+با cursor سمت سرور اجرا می‌شوند و خطا می‌دهند.
+"""
+import os
+import sys
+import tempfile
+
+_DB_PATH = os.path.join(tempfile.mkdtemp(), "test.db")
+os.environ["DB_URI"] = f"sqlite:///{_DB_PATH}"
+os.environ.setdefault("RATE_LIMIT_DB", os.path.join(tempfile.mkdtemp(), "ratelimit.sqlite3"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from sqlalchemy import event, text
+
+import app
+
+@pytest.fixture(scope="module", autouse=True)
+def course_data():
+    with app.engine.begin() as conn:
+        conn.execute(text("CREATE TABLE IF NOT EXISTS students (id INTEGER, name TEXT)"))
+        conn.execute(text("DELETE FROM students"))
+        conn.execute(text("INSERT INTO students VALUES (1, 'a'), (2, 'b'), (3, 'c')"))
+
+def test_materialize_references_does_not_leak_execution_options():
+    leaked = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if conn.get_execution_options().get("stream_results"):
+            leaked.append(" ".join(statement.split())[:80])
+
+    bind = app.engine.get()
+    event.listen(bind, "before_cursor_execute", before_cursor_execute)
+    try:
+        summaries = app.materialize_references(
+            "3", "علوم کامپیوتر", "SELECT id, name FROM students;\n# number 2\nSELECT COUNT(*) FROM students;"
+        )
+    finally:
+        event.remove(bind, "before_cursor_execute", before_cursor_execute)
+
+    assert [meta["qnum"] for meta in summaries] == [1, 2]
+    assert leaked == []
+
+def test_matches_reference_meta_does_not_leak_execution_options():
+    app.materialize_references("3", "علوم کامپیوتر", "SELECT id, name FROM students;")
+    meta = app.load_reference_meta("3", "cs")[1]
+    table = app.reference_table_name("3", 1, "cs")
+
+    with app.engine.connect() as conn:
+        before = dict(conn.get_execution_options())
+        assert app.matches_reference_meta(conn, "SELECT id, name FROM students ORDER BY id DESC", meta, table)
+        assert not app.matches_reference_meta(conn, "SELECT id, name FROM students WHERE id < 3", meta, table)
+        assert dict(conn.get_execution_options()) == before